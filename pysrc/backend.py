@@ -1,21 +1,40 @@
+import json
+import math
+import os
 import pprint
 import random
+import threading
+import time
 from pathlib import Path
 
 import cv2
 import numpy as np
-import torch
-from config import Config, config
-from database_server import MilvusLocalServer
+from compactor import Compactor
+from config import Config, config, save_active_model
+from database_server import (
+    MilvusLocalServer,
+    NumpyLocalServer,
+    create_database_server,
+)
 from embedding_server import OpenCLIPEmbeddingServer
 from image_server import ImageLocalServer
 from loguru import logger
+from reindex import ReindexJob
+from result_cache import ResultCache, next_fetch_size, score_cutoff
+from tag_server import TagLocalServer
 from tqdm import tqdm
 
 
 class BackendServer:
     """Backend server for image search"""
 
+    # minimum similarity of the results of image queries
+    IMAGE_MIN_SIMILARITY = 0.5
+    # text queries keep the results with a zero-shot probability within 1% of the best one
+    TEXT_SCORE_MARGIN = math.log(100) / 100
+    # maximum number of results of a search, paged by `load_more`
+    MAX_CANDIDATES = 1024
+
     def __init__(self, config: Config):
         """Initialize the backend server
 
@@ -28,20 +47,20 @@ class BackendServer:
 
         logger.info("Initialize embedding server")
         if self.config.use_open_clip:
-            self.embedding_server = OpenCLIPEmbeddingServer(
-                self.config.open_clip_model_name
+            # compact storage dtypes are quantized from float16 by the database
+            embedding_server = OpenCLIPEmbeddingServer(
+                self.config.open_clip_model_name,
+                "float32" if self.config.embedding_dtype == "float32" else "float16",
             )
         else:
             raise ValueError("Only support OpenCLIP for now")
 
         logger.info("Initialize database server")
-        if self.config.use_milvus and self.config.use_local_database:
-            self.database_server = MilvusLocalServer(
-                self.config.local_database_fpath,
-                self.embedding_server.get_embedding_dimension(),
-            )
-        else:
-            raise ValueError("Only support local Milvus for now")
+        database_server = create_database_server(
+            self.config, embedding_server.get_embedding_dimension()
+        )
+        # swapped as a whole by `cutover`, so searches read a consistent pair without locking
+        self._index = (embedding_server, database_server)
 
         logger.info("Initialize image server")
         if self.config.use_local_image:
@@ -49,13 +68,126 @@ class BackendServer:
         else:
             raise ValueError("Only support local images for now")
 
+        logger.info("Initialize tag server")
+        self.tag_server = TagLocalServer(self.config.local_image_dpath / "tags.jsonl")
+        self._set_label_embeddings(self.embedding_server)
+
+        # guards writes, searches never take it
+        self._lock = threading.RLock()
+        self._reindex_job: ReindexJob | None = None
+
+        # the change across the servers in flight, see `_begin`
+        self._pending_fpath = self.config.local_image_dpath / "pending.json"
+        self._recover()
         self._check()
 
+        # results of recent searches, for `load_more`
+        self.result_cache = ResultCache()
+
+        # removes the files of images deleted by `delete_images` in the background
+        self.compactor = Compactor(
+            self.image_server,
+            self.database_server,
+            batch_size=self.config.compactor_batch_size,
+            max_files_per_second=self.config.compactor_max_files_per_second,
+            max_bytes_per_second=self.config.compactor_max_bytes_per_second,
+            min_deleted_fraction=self.config.compactor_min_deleted_fraction,
+            lock=self._lock,
+        )
+        self.compactor.start()
+
     def _check(self):
         assert (
             self.database_server.size() == self.image_server.size()
         ), f"Database size {self.database_server.size()} != Image size {self.image_server.size()}"
 
+    def _begin(self, record: dict) -> None:
+        """Record a change across the servers before making it, see `_recover`
+
+        Args:
+            record (dict): {"op": "insert", "count": number of images} or {"op": "delete", "ids": image IDs}
+        """
+        tmp_fpath = self._pending_fpath.with_suffix(".tmp")
+        with open(tmp_fpath, "w") as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fpath, self._pending_fpath)
+
+    def _end(self) -> None:
+        """Clear the record of the change, once all the servers are changed"""
+        self._pending_fpath.unlink()
+
+    def _recover(self) -> None:
+        """Finish a change across the servers interrupted by a crash
+
+        Only the change recorded by `_begin` is repaired, an interrupted delete
+        is finished, and the embeddings of an interrupted insert whose images
+        were not saved are deleted. Any other mismatch fails `_check`.
+        """
+        if not self._pending_fpath.exists():
+            return
+        record = json.loads(self._pending_fpath.read_text())
+        logger.warning(f"Recover the interrupted {record['op']} in {self._pending_fpath}")
+        if record["op"] == "delete":
+            ids = record["ids"]
+            self.database_server.delete_batch(ids)
+            self.image_server.tombstone([id for id in ids if self.image_server.has(id)])
+            self.tag_server.delete_batch(ids)
+        else:
+            image_ids = set(self.image_server.all_id())
+            ids = [id for id in self.database_server.all_id() if id not in image_ids]
+            assert (
+                len(ids) <= record["count"]
+            ), f"{len(ids)} embeddings have no image, but only {record['count']} were being inserted"
+            if len(ids) > 0:
+                self.database_server.delete_batch(ids)
+                self.tag_server.delete_batch(ids)
+        self._end()
+
+    def _set_label_embeddings(self, embedding_server: OpenCLIPEmbeddingServer) -> None:
+        """Embed the label prompts of the tag server with the embedding server
+
+        Args:
+            embedding_server (OpenCLIPEmbeddingServer): embedding server of the image embeddings
+        """
+        prompts = self.tag_server.prompts()
+        embs = embedding_server.generate_embeddings_for_texts(prompts)
+        self.tag_server.set_label_embeddings(embs)
+
+    def _tag_candidates(self, tags: list[str], match_all: bool = True) -> np.ndarray:
+        """Get the images having the tags, to pre-filter a search with
+
+        Args:
+            tags (list[str]): tags to pre-filter with
+            match_all (bool, optional): images having all the tags, otherwise any of them. Defaults to True
+
+        Returns:
+            np.ndarray: sorted image IDs
+        """
+        ids = self.tag_server.search(tags, match_all)
+        return np.sort(np.fromiter(ids, dtype=np.int64, count=len(ids)))
+
+    def _index_servers(
+        self,
+    ) -> tuple[OpenCLIPEmbeddingServer, MilvusLocalServer | NumpyLocalServer]:
+        """Get the embedding server and the database server as a consistent pair
+
+        Returns:
+            tuple[OpenCLIPEmbeddingServer, MilvusLocalServer | NumpyLocalServer]: embedding server and database server
+        """
+        return self._index
+
+    @property
+    def embedding_server(self) -> OpenCLIPEmbeddingServer:
+        """Embedding server of the current model"""
+        return self._index[0]
+
+    @property
+    def database_server(self) -> MilvusLocalServer | NumpyLocalServer:
+        """Database server of the current model"""
+        return self._index[1]
+
     def get_database_size(self) -> int:
         """Get the number of images in the database
 
@@ -78,28 +210,70 @@ class BackendServer:
         assert image is not None, f"Invalid image: {image}"
         return image
 
-    def insert_image(self, image: np.ndarray | Path) -> int:
+    def insert_image(
+        self, image: np.ndarray | Path, source: str = "", uploader: str = ""
+    ) -> int:
         """Insert an image
 
         Args:
             image (np.ndarray | Path): numpy array of the image or image path
+            source (str, optional): where the image comes from, stored as metadata for search filters. Defaults to ""
+            uploader (str, optional): who uploads the image, stored as metadata for search filters. Defaults to ""
 
         Returns:
             int: image unique ID
         """
-        if isinstance(image, Path):
-            image = self.load_image(image)
+        return self.insert_images([image], source, uploader)[0]
 
-        assert isinstance(image, np.ndarray), f"Invalid image type: {type(image)}"
-        assert len(image.shape) == 3, f"Invalid image shape: {image.shape}"
-        assert image.shape[-1] == 3, f"Invalid image channel: {image.shape[-1]}"
-        assert image.dtype == np.uint8, f"Invalid image dtype: {image.dtype}"
+    def insert_images(
+        self, images: list[np.ndarray | Path], source: str = "", uploader: str = ""
+    ) -> list[int]:
+        """Insert a batch of images, embedded and tagged in one pass
 
-        emb = self.embedding_server.generate_embedding_for_image(image)
-        id = self.database_server.insert(emb)
-        _ = self.image_server.insert(image, id)
+        Args:
+            images (list[np.ndarray | Path]): numpy arrays of the images or image paths
+            source (str, optional): where the images come from, see `insert_image`. Defaults to ""
+            uploader (str, optional): who uploads the images, see `insert_image`. Defaults to ""
 
-        return id
+        Returns:
+            list[int]: image unique IDs
+        """
+        images = [
+            self.load_image(image) if isinstance(image, Path) else image
+            for image in images
+        ]
+        for image in images:
+            assert isinstance(image, np.ndarray), f"Invalid image type: {type(image)}"
+            assert len(image.shape) == 3, f"Invalid image shape: {image.shape}"
+            assert image.shape[-1] == 3, f"Invalid image channel: {image.shape[-1]}"
+            assert image.dtype == np.uint8, f"Invalid image dtype: {image.dtype}"
+
+        ingest_time = int(time.time())
+        metadata = [
+            {
+                "width": image.shape[1],
+                "height": image.shape[0],
+                "ingest_time": ingest_time,
+                "source": source,
+                "uploader": uploader,
+            }
+            for image in images
+        ]
+        while True:
+            index = self._index
+            embedding_server, database_server = index
+            embs = embedding_server.generate_embeddings_for_images(images)
+            with self._lock:
+                if self._index is not index:
+                    # cut over while embedding, embed again with the new model
+                    continue
+                self._begin({"op": "insert", "count": len(images)})
+                ids = database_server.insert_batch(embs, metadata=metadata)
+                self.tag_server.insert_batch(ids, self.tag_server.tag(embs))
+                for image, id in zip(images, ids):
+                    _ = self.image_server.insert(image, id)
+                self._end()
+            return ids
 
     def delete_image(self, id: int) -> None:
         """Delete an image by ID
@@ -107,8 +281,40 @@ class BackendServer:
         Args:
             id (int): image unique ID
         """
-        self.database_server.delete(id)
-        self.image_server.delete(id)
+        with self._lock:
+            assert self.image_server.has(id), f"Image not found: {id=}"
+            self._begin({"op": "delete", "ids": [id]})
+            self.database_server.delete(id)
+            self.image_server.delete(id)
+            self.tag_server.delete(id)
+            self._end()
+
+    def delete_images(self, ids: list[int]) -> None:
+        """Delete images by IDs in bulk
+
+        The images are excluded from search results at once, and their storage
+        is reclaimed later by the compactor, see `self.compactor` for progress
+        and throttling. Unknown or already deleted IDs are skipped.
+
+        Args:
+            ids (list[int]): image unique IDs
+        """
+        with self._lock:
+            # unknown or already deleted images are skipped before anything is changed
+            found = [id for id in dict.fromkeys(ids) if self.image_server.has(id)]
+            if len(found) < len(ids):
+                logger.warning(f"Skip {len(ids) - len(found)} unknown or duplicated IDs")
+            if len(found) == 0:
+                return
+            ids = found
+            # a crash in the middle is finished at startup, see `_recover`
+            self._begin({"op": "delete", "ids": ids})
+            for i in range(0, len(ids), 1024):
+                self.database_server.delete_batch(ids[i : i + 1024])
+            self.image_server.tombstone(ids)
+            self.tag_server.delete_batch(ids)
+            self._end()
+        self.compactor.wake()
 
     def get_image(self, id: int) -> np.ndarray:
         """Get the image content in numpy array
@@ -132,43 +338,278 @@ class BackendServer:
         """
         return self.image_server.get_uri(id)
 
-    def search_with_image(self, image: np.ndarray | Path, top_k: int) -> list[int]:
+    def get_image_tags(self, id: int) -> list[str]:
+        """Get the tags of an image, generated at insertion
+
+        Args:
+            id (int): image unique ID
+
+        Returns:
+            list[str]: tags of the image, most probable first
+        """
+        return self.tag_server.get_tags(id)
+
+    def _search(
+        self,
+        embedding: np.ndarray,
+        database_server: MilvusLocalServer | NumpyLocalServer,
+        top_k: int,
+        filter: str,
+        min_similarity: float,
+        margin: float | None = None,
+        candidate_ids: np.ndarray | None = None,
+    ) -> tuple[list[int], str | None]:
+        """Search all results above the cutoff, and cache them for `load_more`
+
+        The results are fetched from the database until the cutoff is reached,
+        the fetch size is estimated from the decay of the scores.
+
+        Args:
+            embedding (np.ndarray): numpy array of the query embedding
+            database_server (MilvusLocalServer | NumpyLocalServer): database server of the embedding
+            top_k (int): maximum number of results of the first page
+            filter (str): filter expression on the image metadata
+            min_similarity (float): absolute minimum similarity of the results
+            margin (float | None, optional): maximum distance from the best score, see `score_cutoff`. Defaults to None
+            candidate_ids (np.ndarray | None, optional): only search these images, see `_tag_candidates`. Defaults to None, which searches all
+
+        Returns:
+            tuple[list[int], str | None]: list of image IDs of the first page, and the cursor of the next page
+        """
+        fetch = 2 * top_k
+        max_candidates = max(self.MAX_CANDIDATES, fetch)
+        while True:
+            results = database_server.search(
+                embedding,
+                fetch,
+                distance_threshold=min_similarity,
+                filter=filter,
+                candidate_ids=candidate_ids,
+            )
+            scores = np.array([r[1] for r in results], dtype=np.float32)
+            cutoff = score_cutoff(scores, min_similarity, margin)
+            size = next_fetch_size(scores, cutoff, fetch, max_candidates)
+            if size == 0:
+                break
+            logger.debug(f"Fetch {size} results, {scores[-1]=} is above {cutoff=}")
+            fetch = size
+        kept = int(np.count_nonzero(scores >= cutoff))
+        logger.trace(f"{cutoff=} {kept=} {results=}")
+        return self.result_cache.put([r[0] for r in results[:kept]], top_k)
+
+    def search_with_image(
+        self,
+        image: np.ndarray | Path,
+        top_k: int,
+        filter: str = "",
+        tags: list[str] | None = None,
+    ) -> list[int]:
         """Search similar images with an image
 
         Args:
             image (np.ndarray | Path): numpy array of the image or image path
             top_k (int): maximum number of results to return
+            filter (str, optional): filter expression on the image metadata, e.g. 'width >= 640 and source == "coco"'. Defaults to "", which matches all
+            tags (list[str] | None, optional): only search the images having all the tags. Defaults to None
+
+        Raises:
+            ValueError: if a tag is not a known label
 
         Returns:
             list[int]: list of image IDs
         """
+        return self.paged_search_with_image(image, top_k, filter, tags)[0]
+
+    def paged_search_with_image(
+        self,
+        image: np.ndarray | Path,
+        top_k: int,
+        filter: str = "",
+        tags: list[str] | None = None,
+    ) -> tuple[list[int], str | None]:
+        """Search similar images with an image, see `search_with_image`
+
+        Returns:
+            tuple[list[int], str | None]: list of image IDs, and the cursor of the next page for `load_more`, None if there is no more
+        """
+        candidate_ids = None
+        if tags:
+            candidate_ids = self._tag_candidates(tags)
+            if len(candidate_ids) == 0:
+                return [], None
         if isinstance(image, Path):
             image = self.load_image(image)
-        emb = self.embedding_server.generate_embedding_for_image(image)
-        results = self.database_server.search(emb, top_k, distance_threshold=0.5)
-        return [r[0] for r in results]
+        embedding_server, database_server = self._index_servers()
+        emb = embedding_server.generate_embedding_for_image(image)
+        return self._search(
+            emb,
+            database_server,
+            top_k,
+            filter,
+            self.IMAGE_MIN_SIMILARITY,
+            candidate_ids=candidate_ids,
+        )
 
-    def search_with_text(self, text: str, top_k: int) -> list[int]:
+    def search_with_text(
+        self,
+        text: str,
+        top_k: int,
+        filter: str = "",
+        tags: list[str] | None = None,
+    ) -> list[int]:
         """Search similar images with a text
 
+        When the text mentions known tags, only the images having any of them
+        are re-ranked, instead of searching all images. All images are searched
+        if they give fewer than `top_k` results.
+
         Args:
             text (str): text string
             top_k (int): maximum number of results to return
+            filter (str, optional): filter expression on the image metadata, see `search_with_image`. Defaults to "", which matches all
+            tags (list[str] | None, optional): only search the images having all the tags. Defaults to None, which uses the tags mentioned in the text
+
+        Raises:
+            ValueError: if a tag is not a known label
 
         Returns:
             list[int]: list of image IDs
         """
-        emb = self.embedding_server.generate_embedding_for_text(text)
-        results = self.database_server.search(emb, top_k * 2, distance_threshold=0.0)
-        ids = [r[0] for r in results]
-        distances = torch.tensor([100.0 * r[1] for r in results], dtype=torch.float32)
-        softmaxs = torch.nn.functional.softmax(distances, dim=0)
-        result_ids = []
-        for id, dist, sm in zip(ids, distances, softmaxs):
-            logger.trace(f"{id=} distance={dist} softmax={sm}")
-            if sm >= 0.01:
-                result_ids.append(id)
-        return result_ids[:top_k]
+        return self.paged_search_with_text(text, top_k, filter, tags)[0]
+
+    def paged_search_with_text(
+        self,
+        text: str,
+        top_k: int,
+        filter: str = "",
+        tags: list[str] | None = None,
+    ) -> tuple[list[int], str | None]:
+        """Search similar images with a text, see `search_with_text`
+
+        Returns:
+            tuple[list[int], str | None]: list of image IDs, and the cursor of the next page for `load_more`, None if there is no more
+        """
+        embedding_server, database_server = self._index_servers()
+        if tags:
+            candidate_ids = self._tag_candidates(tags)
+            if len(candidate_ids) == 0:
+                return [], None
+            emb = embedding_server.generate_embedding_for_text(text)
+            return self._search(
+                emb,
+                database_server,
+                top_k,
+                filter,
+                0.0,
+                self.TEXT_SCORE_MARGIN,
+                candidate_ids=candidate_ids,
+            )
+
+        emb = embedding_server.generate_embedding_for_text(text)
+        if (
+            self.tag_server.size() == self.image_server.size()
+            and (matched_tags := self.tag_server.match(text))
+        ):
+            # answer from the posting lists, a tag mentioned in the text may be missed by the tagger,
+            # so any of them is enough, and all images are searched if there are not enough results
+            candidate_ids = self._tag_candidates(matched_tags, match_all=False)
+            logger.debug(f"{matched_tags=} {len(candidate_ids)=}")
+            if len(candidate_ids) >= top_k:
+                page, cursor = self._search(
+                    emb,
+                    database_server,
+                    top_k,
+                    filter,
+                    0.0,
+                    self.TEXT_SCORE_MARGIN,
+                    candidate_ids=candidate_ids,
+                )
+                if len(page) >= top_k:
+                    return page, cursor
+        return self._search(
+            emb, database_server, top_k, filter, 0.0, self.TEXT_SCORE_MARGIN
+        )
+
+    def load_more(self, cursor: str, top_k: int) -> tuple[list[int], str | None]:
+        """Get the next page of a search from the cache, without searching again
+
+        Args:
+            cursor (str): cursor returned with the previous page
+            top_k (int): maximum number of results to return
+
+        Returns:
+            tuple[list[int], str | None]: list of image IDs, and the cursor of the next page, None if there is no more
+        """
+        ids, cursor = self.result_cache.page(cursor, top_k)
+        # images deleted since the search are skipped, so a page can be short
+        return [id for id in ids if self.image_server.has(id)], cursor
+
+    def start_reindex(
+        self,
+        config: Config,
+        batch_size: int = 32,
+        max_images_per_second: float | None = None,
+    ) -> ReindexJob:
+        """Re-embed all images with another model in the background, then cut over to it
+
+        The service keeps serving with the current model meanwhile.
+
+        Args:
+            config (Config): configuration of the target model, see `config.create_config`
+            batch_size (int, optional): number of images embedded in one forward pass. Defaults to 32
+            max_images_per_second (float | None, optional): throttle the job to protect live queries. Defaults to None, which means no limit
+
+        Returns:
+            ReindexJob: the running job, for progress or to stop it
+        """
+        # a stopped or failed job is replaced, the new one resumes from its shadow database
+        assert (
+            self._reindex_job is None or not self._reindex_job.is_running()
+        ), "Re-indexing is already running"
+        assert (
+            config.local_image_dpath == self.config.local_image_dpath
+        ), f"Re-indexing must share the images {self.config.local_image_dpath}"
+        self._reindex_job = ReindexJob(
+            self.image_server,
+            config,
+            batch_size,
+            max_images_per_second,
+            self._lock,
+            metadata_server=self.database_server,
+        )
+        self._reindex_job.start(on_caught_up=self.cutover)
+        return self._reindex_job
+
+    def cutover(self, job: ReindexJob) -> None:
+        """Switch to the model and database of a caught-up re-indexing job
+
+        Catch-up passes run without the lock until few images are left. Writes
+        are then blocked only for the last, unthrottled pass, and searches are
+        never blocked, they switch with one assignment of the server pair. The
+        new model is recorded next to the images, so that it is kept after
+        restart, see `config.load_active_model`.
+
+        Args:
+            job (ReindexJob): re-indexing job, see `start_reindex`
+        """
+        # the label bank of the new model is ready before writes are blocked
+        prompts = self.tag_server.prompts()
+        label_embs = job.embedding_server.generate_embeddings_for_texts(prompts)
+        while job.run() >= job.batch_size:
+            pass
+        with self._lock:
+            job.run(throttle=False)
+            assert (
+                job.database_server.size() == self.image_server.size()
+            ), f"Shadow database size {job.database_server.size()} != Image size {self.image_server.size()}"
+            logger.info(f"Cut over to {job.config.open_clip_model_name}")
+            # the old database misses the changes from now on, it must not be reopened
+            save_active_model(job.config)
+            self.config = job.config
+            self._index = (job.embedding_server, job.database_server)
+            self.compactor.database_server = job.database_server
+            self.tag_server.set_label_embeddings(label_embs)
+            self._reindex_job = None
 
 
 if __name__ == "__main__":
@@ -182,5 +623,10 @@ if __name__ == "__main__":
         test_image_fpaths = list(
             random.choices(all_test_image_fpaths, k=config.test_image_count)
         )
-        for image_fpath in tqdm(test_image_fpaths):
-            id = server.insert_image(image_fpath)
+        batch_size = 32
+        for i in tqdm(range(0, len(test_image_fpaths), batch_size)):
+            ids = server.insert_images(
+                test_image_fpaths[i : i + batch_size], source="coco-val2017"
+            )
+        # the next start maps the bulk load instead of replaying it
+        server.database_server.snapshot()
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import threading
+import time
+
+from database_server import MilvusLocalServer, NumpyLocalServer
+from image_server import ImageLocalServer
+from loguru import logger
+
+
+class Compactor:
+    """Reclaim the storage of deleted images in the background
+
+    Deleted images are tombstoned on the image server, and their embeddings
+    are deleted from the database at once, see `BackendServer.delete_images`.
+    The compactor then removes the image files in batches. Once all of them
+    are removed, it compacts the database if enough of its entities are
+    deleted, since compacting rewrites all of them. Both are throttled, and
+    neither holds the writers back for a whole pass.
+    """
+
+    def __init__(
+        self,
+        image_server: ImageLocalServer,
+        database_server: MilvusLocalServer | NumpyLocalServer,
+        batch_size: int = 256,
+        max_files_per_second: float | None = None,
+        database_batch_size: int = 65536,
+        max_bytes_per_second: float | None = None,
+        min_deleted_fraction: float = 0.1,
+        lock: threading.RLock | None = None,
+    ):
+        """Initialize the compactor
+
+        Args:
+            image_server (ImageLocalServer): image server holding the tombstoned images
+            database_server (MilvusLocalServer | NumpyLocalServer): database server to be compacted
+            batch_size (int, optional): number of files removed in one batch. Defaults to 256
+            max_files_per_second (float | None, optional): throttle the compactor to protect the file system. Defaults to None, which means no limit
+            database_batch_size (int, optional): number of embeddings written in one batch when compacting the database. Defaults to 65536
+            max_bytes_per_second (float | None, optional): throttle the writes when compacting the database. Defaults to None, which means no limit
+            min_deleted_fraction (float, optional): compact the database once this fraction of its entities are deleted. Defaults to 0.1
+            lock (threading.RLock | None, optional): lock held by the writers of the image server and the database. Defaults to None
+        """
+        assert batch_size > 0, f"Invalid batch size: {batch_size}"
+        self.image_server = image_server
+        self.database_server = database_server
+        self.batch_size = batch_size
+        self.max_files_per_second = max_files_per_second
+        self.database_batch_size = database_batch_size
+        self.max_bytes_per_second = max_bytes_per_second
+        self.min_deleted_fraction = min_deleted_fraction
+        self._lock = lock if lock is not None else threading.RLock()
+
+        self.done_count = 0
+        self._paused = False
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def pending_count(self) -> int:
+        """Get the number of image files waiting to be removed
+
+        Returns:
+            int: number of image files
+        """
+        return self.image_server.tombstone_count()
+
+    def run(self) -> int:
+        """Remove all pending image files, then compact the database
+
+        Returns:
+            int: number of image files removed
+        """
+        count = 0
+        while self.pending_count() > 0:
+            if self._stop_event.is_set() or self._paused:
+                return count
+            start = time.monotonic()
+
+            with self._lock:
+                n = self.image_server.compact(self.batch_size)
+            count += n
+            self.done_count += n
+            logger.trace(f"Removed {count} images, {self.pending_count()} pending")
+
+            if self.max_files_per_second is not None:
+                budget = n / self.max_files_per_second
+                time.sleep(max(0.0, budget - (time.monotonic() - start)))
+
+        if count > 0:
+            logger.info(f"Removed {count} images")
+            database_server = self.database_server
+            deleted = database_server.deleted_count()
+            if deleted >= self.min_deleted_fraction * (database_server.size() + deleted):
+                # the database locks only to hand off its changes, see `NumpyLocalServer.compact`
+                database_server.compact(
+                    self.database_batch_size, self.max_bytes_per_second
+                )
+        return count
+
+    def wake(self) -> None:
+        """Ask the background thread to run, e.g. after images are tombstoned"""
+        self._wake_event.set()
+
+    def pause(self) -> None:
+        """Pause the background thread after the current batch"""
+        self._paused = True
+
+    def resume(self) -> None:
+        """Resume the background thread"""
+        self._paused = False
+        self.wake()
+
+    def start(self) -> None:
+        """Run the compactor in a background thread, it waits to be woken up"""
+        assert self._thread is None, "Compactor is already started"
+
+        def _target():
+            while not self._stop_event.is_set():
+                self._wake_event.wait()
+                self._wake_event.clear()
+                if not self._stop_event.is_set():
+                    self.run()
+
+        self._thread = threading.Thread(target=_target, name="compactor", daemon=True)
+        self._thread.start()
+        self.wake()
+
+    def stop(self) -> None:
+        """Stop the background thread after the current batch, pending files are kept tombstoned"""
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import dataclasses
+import json
 import os
 from pathlib import Path
 
+from loguru import logger
 from pydantic.dataclasses import dataclass
 from pydantic.types import DirectoryPath
 
@@ -14,6 +17,14 @@ class Config:
     use_milvus: bool = True
     use_local_database: bool = True
     local_database_relative_fpath: Path | None = None
+    # storage dtype of the embeddings, "float32" or "int8", which needs the in-memory database
+    # and takes 1/4 of the RAM of "float32" while searching about as fast
+    embedding_dtype: str = "float32"
+    # background removal of deleted images, see `Compactor`
+    compactor_batch_size: int = 256
+    compactor_max_files_per_second: float | None = None
+    compactor_max_bytes_per_second: float | None = None
+    compactor_min_deleted_fraction: float = 0.1
     # images
     use_local_image: bool = True
     local_image_relative_dpath: Path | None = None
@@ -48,15 +59,118 @@ class Config:
             self.test_image_dpath = None
 
 
-model_name = "ViT-L-14-336-quickgelu"
-model_author = "openai"
-config = Config(
-    root_dpath=Path(__file__).parent.parent,
-    local_database_relative_fpath=Path(f"data/{model_name}.{model_author}.db"),
-    local_image_relative_dpath=Path("data/images"),
-    open_clip_model_name=(model_name, model_author),
-    test_image_relative_dpath=Path("data/inputs/val2017"),
-    test_image_count=5000
-    if os.environ.get("TEST_IMAGE_COUNT", "0") == "0"
-    else int(os.environ["TEST_IMAGE_COUNT"]),
+def create_config(
+    model_name: str,
+    model_author: str,
+    use_milvus: bool = True,
+    embedding_dtype: str = "float32",
+) -> Config:
+    """Create the configuration of the demo for an OpenCLIP model
+
+    The database file is named after the model, so every model has its own
+    embeddings while sharing the same images.
+
+    Args:
+        model_name (str): pretrained model name
+        model_author (str): pretrained model author
+        use_milvus (bool, optional): use Milvus, otherwise the in-memory database. Defaults to True
+        embedding_dtype (str, optional): storage dtype of the embeddings, "int8" to save RAM, see `Config.embedding_dtype`. Defaults to "float32"
+
+    Returns:
+        Config: configuration object
+    """
+    if use_milvus:
+        database_fname = f"{model_name}.{model_author}.db"
+    else:
+        database_fname = f"{model_name}.{model_author}.{embedding_dtype}.vec"
+    return Config(
+        root_dpath=Path(__file__).parent.parent,
+        use_milvus=use_milvus,
+        local_database_relative_fpath=Path("data") / database_fname,
+        embedding_dtype=embedding_dtype,
+        local_image_relative_dpath=Path("data/images"),
+        open_clip_model_name=(model_name, model_author),
+        test_image_relative_dpath=Path("data/inputs/val2017"),
+        test_image_count=5000
+        if os.environ.get("TEST_IMAGE_COUNT", "0") == "0"
+        else int(os.environ["TEST_IMAGE_COUNT"]),
+    )
+
+
+def active_model_fpath(config: Config) -> Path:
+    """Get the file recording the model that the images were cut over to
+
+    It lives next to the images, which are shared by the databases of all models.
+
+    Args:
+        config (Config): configuration object
+
+    Returns:
+        Path: file path of the active model record
+    """
+    return config.local_image_dpath / "active_model.json"
+
+
+def save_active_model(config: Config) -> None:
+    """Record the model and database of a configuration as the active ones, see `load_active_model`
+
+    Args:
+        config (Config): configuration object to be kept after restart
+    """
+    fpath = active_model_fpath(config)
+    record = {
+        "open_clip_model_name": list(config.open_clip_model_name),
+        "use_milvus": config.use_milvus,
+        "embedding_dtype": config.embedding_dtype,
+        "local_database_relative_fpath": str(config.local_database_relative_fpath),
+    }
+    tmp_fpath = fpath.with_suffix(".tmp")
+    with open(tmp_fpath, "w") as f:
+        json.dump(record, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fpath, fpath)
+
+
+def load_active_model(config: Config) -> Config:
+    """Apply the model and database of the last cutover to a configuration
+
+    Once the images are re-indexed and cut over to another model, the database
+    of the previous model misses the later changes, so the record takes
+    precedence over the environment variables. Remove it to go back to them.
+
+    Args:
+        config (Config): configuration object, e.g. from the environment variables
+
+    Returns:
+        Config: configuration object of the active model
+    """
+    fpath = active_model_fpath(config)
+    if not fpath.exists():
+        return config
+    with open(fpath) as f:
+        record = json.load(f)
+    active = dataclasses.replace(
+        config,
+        open_clip_model_name=tuple(record["open_clip_model_name"]),
+        use_milvus=record["use_milvus"],
+        embedding_dtype=record["embedding_dtype"],
+        local_database_relative_fpath=Path(record["local_database_relative_fpath"]),
+    )
+    if active.local_database_fpath != config.local_database_fpath:
+        logger.warning(
+            f"Use {active.open_clip_model_name} of the last cutover, instead of {config.open_clip_model_name}, "
+            f"remove {fpath} to use the environment variables"
+        )
+    return active
+
+
+model_name = os.environ.get("OPEN_CLIP_MODEL_NAME", "ViT-L-14-336-quickgelu")
+model_author = os.environ.get("OPEN_CLIP_MODEL_AUTHOR", "openai")
+config = create_config(
+    model_name,
+    model_author,
+    use_milvus=os.environ.get("USE_MILVUS", "1") == "1",
+    embedding_dtype=os.environ.get("EMBEDDING_DTYPE", "float32"),
 )
+config = load_active_model(config)
@@ -1,10 +1,183 @@
+import ast
+import itertools
 import os
+import threading
+import time
+import zlib
+from collections.abc import Iterable
 from pathlib import Path
 
-import itertools
 import numpy as np
+from config import Config
 from loguru import logger
-from pymilvus import MilvusClient
+from pymilvus import DataType, MilvusClient
+
+# float16 is not offered, numpy converts it to float32 too slowly for scoring
+EMBEDDING_DTYPES = ("float32", "int8")
+
+
+def quantize(embeddings: np.ndarray, dtype: str) -> tuple[np.ndarray, np.ndarray]:
+    """Quantize embeddings into the storage dtype
+
+    "int8" uses a symmetric scale per vector, so that `codes * scales[:, None]`
+    approximates the embeddings. The scales of "float32" are all ones.
+
+    >>> x = np.array([[0.6, -0.8], [0.0, 0.0]], dtype=np.float32)
+    >>> codes, scales = quantize(x, "int8")
+    >>> codes
+    array([[  95, -127],
+           [   0,    0]], dtype=int8)
+    >>> bool(np.allclose(codes * scales[:, None], x, atol=0.01))
+    True
+    >>> quantize(x, "float32")[1]
+    array([1., 1.], dtype=float32)
+
+    Args:
+        embeddings (np.ndarray): numpy array of the embeddings, 2D with shape (count, embedding dimension)
+        dtype (str): storage dtype, one of `EMBEDDING_DTYPES`
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: codes in the storage dtype with the same shape, and float32 scales with shape (count,)
+    """
+    assert dtype in EMBEDDING_DTYPES, f"Invalid embedding dtype: {dtype}"
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype != "int8":
+        scales = np.ones(len(embeddings), dtype=np.float32)
+        return embeddings.astype(dtype), scales
+    scales = np.abs(embeddings).max(axis=1) / 127.0
+    scales[scales == 0.0] = 1.0
+    codes = np.rint(embeddings / scales[:, np.newaxis]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+# scalar metadata stored with every embedding, to be used in search filters
+METADATA_DTYPE = np.dtype(
+    [
+        ("width", "<i4"),
+        ("height", "<i4"),
+        ("ingest_time", "<i8"),
+        ("source", "S64"),
+        ("uploader", "S64"),
+    ]
+)
+
+
+def metadata_array(metadata: list[dict] | None, count: int) -> np.ndarray:
+    """Convert metadata dicts into a structured array of `METADATA_DTYPE`
+
+    >>> a = metadata_array([{"width": 640, "source": "coco"}], 1)
+    >>> metadata_dicts(a)
+    [{'width': 640, 'height': 0, 'ingest_time': 0, 'source': 'coco', 'uploader': ''}]
+
+    Args:
+        metadata (list[dict] | None): metadata of each entity, missing fields are zeros or empty strings
+        count (int): number of entities
+
+    Returns:
+        np.ndarray: structured array with shape (count,)
+    """
+    array = np.zeros(count, dtype=METADATA_DTYPE)
+    if metadata is None:
+        return array
+    assert len(metadata) == count, f"{len(metadata)=} != {count=}"
+    for row, m in zip(array, metadata):
+        for name, value in m.items():
+            assert name in METADATA_DTYPE.names, f"Invalid metadata field: {name}"
+            if isinstance(value, str):
+                value = value.encode()
+                assert (
+                    len(value) <= METADATA_DTYPE[name].itemsize
+                ), f"Metadata {name} is too long: {value}"
+            row[name] = value
+    return array
+
+
+def metadata_dicts(array: np.ndarray) -> list[dict]:
+    """Convert a structured array of `METADATA_DTYPE` into metadata dicts
+
+    Args:
+        array (np.ndarray): structured array of `METADATA_DTYPE`
+
+    Returns:
+        list[dict]: metadata of each entity
+    """
+    return [
+        {
+            name: value.decode() if isinstance(value, bytes) else value
+            for name, value in zip(METADATA_DTYPE.names, row)
+        }
+        for row in array.tolist()
+    ]
+
+
+def filter_mask(expression: str, columns: dict[str, np.ndarray]) -> np.ndarray:
+    """Evaluate a Milvus filter expression on numpy columns
+
+    Supports comparisons (`==`, `!=`, `<`, `<=`, `>`, `>=`, chained), `in` and
+    `not in` lists, `and`, `or`, `not`, and parentheses.
+
+    >>> columns = {"width": np.array([320, 640, 1024]), "source": np.array([b"a", b"b", b"a"])}
+    >>> filter_mask('width >= 640 and source == "a"', columns)
+    array([False, False,  True])
+    >>> filter_mask('not (300 < width < 700) or source in ["b"]', columns)
+    array([False,  True,  True])
+
+    Args:
+        expression (str): filter expression
+        columns (dict[str, np.ndarray]): field name to the numpy array of its values, strings are bytes
+
+    Returns:
+        np.ndarray: boolean mask of the matching rows
+    """
+    count = len(next(iter(columns.values())))
+
+    def _value(node: ast.AST):
+        if isinstance(node, ast.Name):
+            if node.id not in columns:
+                raise ValueError(f"Invalid filter field: {node.id}")
+            return columns[node.id]
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [_value(e) for e in node.elts]
+        value = ast.literal_eval(node)
+        return value.encode() if isinstance(value, str) else value
+
+    def _mask(node: ast.AST) -> np.ndarray:
+        if isinstance(node, ast.BoolOp):
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            masks = [_mask(v) for v in node.values]
+            return combine.reduce(masks)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return ~_mask(node.operand)
+        if isinstance(node, ast.Compare):
+            mask = np.ones(count, dtype=bool)
+            left = _value(node.left)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = _value(comparator)
+                if isinstance(op, (ast.In, ast.NotIn)):
+                    mask &= np.isin(left, right, invert=isinstance(op, ast.NotIn))
+                elif type(op) in _COMPARE_UFUNCS:
+                    mask &= _COMPARE_UFUNCS[type(op)](left, right)
+                else:
+                    raise ValueError(f"Unsupported filter operator: {ast.dump(op)}")
+                left = right
+            return mask
+        raise ValueError(f"Unsupported filter expression: {ast.unparse(node)}")
+
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid filter expression: {expression}") from e
+    return _mask(tree.body)
+
+
+_COMPARE_UFUNCS = {
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+}
 
 
 class MilvusLocalServer:
@@ -58,12 +231,15 @@ class MilvusLocalServer:
     >>> os.unlink("/tmp/test_milvus.db")
     """
 
-    def __init__(self, database_fpath: Path, embedding_dimension: int) -> None:
+    def __init__(
+        self, database_fpath: Path, embedding_dimension: int, auto_id: bool = True
+    ) -> None:
         """Initialize Milvus database on local file system
 
         Args:
             database_fpath (Path): file path of the Milvus database, must ends with ".db"
             embedding_dimension (int): dimension of the embedding from the embedding server
+            auto_id (bool, optional): let Milvus assign IDs when creating a new collection, otherwise IDs are given by the caller (e.g. a re-indexing job that must keep the image IDs). Defaults to True
         """
         logger.info(f"Initialize Milvus database with local file {database_fpath}")
         if database_fpath.exists():
@@ -75,18 +251,50 @@ class MilvusLocalServer:
         self.collection_name = "multimodal_embeddings"
         if not self.client.has_collection(collection_name="multimodal_embeddings"):
             logger.info(f"Create a collection {self.collection_name}")
+            schema = self.client.create_schema(
+                auto_id=auto_id, enable_dynamic_field=False
+            )
+            schema.add_field("id", DataType.INT64, is_primary=True)
+            schema.add_field(
+                "embedding", DataType.FLOAT_VECTOR, dim=embedding_dimension
+            )
+            index_params = self.client.prepare_index_params()
+            index_params.add_index(
+                "embedding", index_type="AUTOINDEX", metric_type="COSINE"
+            )
+            for name in METADATA_DTYPE.names:
+                field_dtype = METADATA_DTYPE[name]
+                if field_dtype.kind == "S":
+                    schema.add_field(
+                        name, DataType.VARCHAR, max_length=field_dtype.itemsize
+                    )
+                elif field_dtype.itemsize == 8:
+                    schema.add_field(name, DataType.INT64)
+                else:
+                    schema.add_field(name, DataType.INT32)
+                # scalar index, so that filters are applied inside the vector search
+                index_params.add_index(name, index_type="INVERTED")
             self.client.create_collection(
                 collection_name=self.collection_name,
-                vector_field_name="embedding",
-                dimension=embedding_dimension,
-                auto_id=True,
-                metric_type="COSINE",
-                enable_dynamic_filed=False,
+                schema=schema,
+                index_params=index_params,
             )
         else:
             logger.warning(
                 f"Collection {self.collection_name} already exists, use the existing collection"
             )
+        # an existing collection keeps the ID policy and the fields it was created with
+        description = self.client.describe_collection(self.collection_name)
+        self.auto_id = description["auto_id"]
+        # Milvus does not report it, see `deleted_count`
+        self._deleted_count = 0
+        field_names = [f["name"] for f in description["fields"]]
+        self.metadata_fields = [n for n in METADATA_DTYPE.names if n in field_names]
+        if len(self.metadata_fields) == 0:
+            logger.warning(
+                f"Collection {self.collection_name} has no metadata, filters are not supported"
+            )
+        self._last_id = 0
 
     def size(self) -> int:
         """Get the total number of entities in the database
@@ -97,22 +305,82 @@ class MilvusLocalServer:
         result = self.client.get_collection_stats(self.collection_name)
         return result["row_count"]
 
-    def insert(self, embedding: np.ndarray) -> int:
+    def _next_id(self) -> int:
+        """Generate a new unique ID for collections without `auto_id`
+
+        IDs are nanosecond timestamps, which never collide with the IDs Milvus
+        assigned to the collection that was re-indexed into this one.
+
+        Returns:
+            int: unique ID
+        """
+        self._last_id = max(self._last_id + 1, time.time_ns())
+        return self._last_id
+
+    def insert(
+        self,
+        embedding: np.ndarray,
+        id: int | None = None,
+        metadata: dict | None = None,
+    ) -> int:
         """Insert an embedding into the database
 
         Args:
             embedding (np.ndarray): numpy array of the embedding to be inserted
+            id (int | None, optional): ID of the embedding, only for collections without `auto_id`. Defaults to None, which generates a new one
+            metadata (dict | None, optional): scalar metadata of the embedding, see `METADATA_DTYPE`. Defaults to None
 
         Returns:
             int: unique ID of the inserted embedding
         """
-        logger.trace(f"Inserting embedding {embedding[0]=}")
-        result = self.client.insert(self.collection_name, {"embedding": embedding})
-        assert result["insert_count"] == 1, f"Insert failed: {result}"
-        return result["ids"][0]
+        return self.insert_batch(
+            embedding[np.newaxis],
+            None if id is None else [id],
+            None if metadata is None else [metadata],
+        )[0]
+
+    def insert_batch(
+        self,
+        embeddings: np.ndarray,
+        ids: list[int] | None = None,
+        metadata: list[dict] | None = None,
+    ) -> list[int]:
+        """Insert a batch of embeddings into the database
+
+        Args:
+            embeddings (np.ndarray): numpy array of the embeddings, 2D with shape (batch, embedding dimension)
+            ids (list[int] | None, optional): IDs of the embeddings, only for collections without `auto_id`. Defaults to None, which generates new ones
+            metadata (list[dict] | None, optional): scalar metadata of each embedding, see `METADATA_DTYPE`. Defaults to None
+
+        Returns:
+            list[int]: unique IDs of the inserted embeddings
+        """
+        logger.trace(f"Inserting {len(embeddings)} embeddings {embeddings[0][0]=}")
+        rows = [
+            {"embedding": e, **{n: m[n] for n in self.metadata_fields}}
+            for e, m in zip(
+                embeddings, metadata_dicts(metadata_array(metadata, len(embeddings)))
+            )
+        ]
+        if self.auto_id:
+            assert ids is None, "IDs are assigned by Milvus for this collection"
+        else:
+            if ids is None:
+                ids = [self._next_id() for _ in embeddings]
+            assert len(ids) == len(embeddings), f"{len(ids)=} != {len(embeddings)=}"
+            for row, id in zip(rows, ids):
+                row["id"] = id
+        result = self.client.insert(self.collection_name, rows)
+        assert result["insert_count"] == len(rows), f"Insert failed: {result}"
+        return list(result["ids"])
 
     def search(
-        self, embedding: np.ndarray, top_k: int, distance_threshold: float = 0.5
+        self,
+        embedding: np.ndarray,
+        top_k: int,
+        distance_threshold: float = 0.5,
+        filter: str = "",
+        candidate_ids: np.ndarray | None = None,
     ) -> list[tuple[int, float]]:
         """Search for embeddings in the database
 
@@ -120,13 +388,21 @@ class MilvusLocalServer:
             embedding (np.ndarray): numpy array of the embedding to be searched, generated by the embedding server
             top_k (int): maximum number of results to return
             distance_threshold (float, optional): threshold of the distance metric. Defaults to 0.5
+            filter (str, optional): Milvus filter expression on the metadata, e.g. 'width >= 640 and source == "coco"', applied inside the vector search. Defaults to "", which matches all
+            candidate_ids (np.ndarray | None, optional): only search these entities, e.g. from the tag index. Defaults to None, which searches all
 
         Returns:
             list[tuple[int, float]]: list of search results, 1st element is the entity ID, 2nd element is the distance
         """
+        if candidate_ids is not None:
+            # Milvus only takes the candidates as a filter expression
+            id_filter = f"id in {np.asarray(candidate_ids).tolist()}"
+            filter = f"({filter}) and {id_filter}" if filter else id_filter
         groups = self.client.search(
             self.collection_name,
             data=[embedding],
+            filter=filter,
+            limit=top_k,
             group_size=top_k,
             strict_group_size=True,
         )
@@ -143,7 +419,730 @@ class MilvusLocalServer:
             )
             for group in groups:
                 for hit in group:
-                    logger.warning(f"{hit}")
+                    logger.trace(f"{hit}")
+        logger.trace(f"{top_k=} {distance_threshold=} {results=}")
+        return results
+
+    def delete(self, id: int) -> None:
+        """Delete an entity from the database use the ID
+
+        Args:
+            id (int): ID of the entity to be deleted
+        """
+        self.delete_batch([id])
+
+    def delete_batch(self, ids: list[int]) -> None:
+        """Delete a batch of entities from the database use their IDs
+
+        Args:
+            ids (list[int]): IDs of the entities to be deleted
+        """
+        self.client.delete(self.collection_name, ids=ids)
+        self._deleted_count += len(ids)
+
+    def deleted_count(self) -> int:
+        """Get the number of entities deleted since the last `compact` of this process
+
+        Returns:
+            int: number of entities
+        """
+        return self._deleted_count
+
+    def compact(
+        self, batch_size: int = 65536, max_bytes_per_second: float | None = None
+    ) -> None:
+        """Reclaim the storage of deleted entities, Milvus runs it in the background
+
+        Args:
+            batch_size (int, optional): unused, Milvus compacts segment by segment. Defaults to 65536
+            max_bytes_per_second (float | None, optional): unused, Milvus throttles itself. Defaults to None
+        """
+        job_id = self.client.compact(self.collection_name)
+        self._deleted_count = 0
+        logger.info(f"Compact collection {self.collection_name}, {job_id=}")
+
+    def snapshot(self) -> None:
+        """Seal the growing segment into persisted segments, so that it is not replayed at startup"""
+        self.client.flush(self.collection_name)
+        logger.info(f"Flush collection {self.collection_name}")
+
+    def get_metadata(self, ids: list[int]) -> list[dict]:
+        """Get the metadata of entities
+
+        Args:
+            ids (list[int]): IDs of the entities
+
+        Returns:
+            list[dict]: metadata of each entity, in the same order as the IDs
+        """
+        rows = self.client.query(
+            self.collection_name,
+            filter=f"id in {list(ids)}",
+            output_fields=self.metadata_fields,
+        )
+        found = {row["id"]: {n: row[n] for n in self.metadata_fields} for row in rows}
+        return [found[id] for id in ids]
+
+    def all_id(self) -> Iterable[int]:
+        """Get all entities' IDs
+
+        Yields:
+            Iterator[int]: entity ID in iterator form
+        """
+        itr = self.client.query_iterator(
+            self.collection_name, batch_size=4096, output_fields=["id"]
+        )
+        while batch := itr.next():
+            for row in batch:
+                yield row["id"]
+        itr.close()
+
+
+class _Segment:
+    """Columns of a batch of entities, in memory or memory-mapped from a snapshot"""
+
+    def __init__(
+        self, ids: np.ndarray, codes: np.ndarray, scales: np.ndarray, meta: np.ndarray
+    ) -> None:
+        self.ids = ids
+        self.codes = codes
+        self.scales = scales
+        self.meta = meta
+        self.count = len(ids)
+        # deleted rows are only masked, memory-mapped columns are read-only
+        self.alive = np.ones(len(ids), dtype=bool)
+
+    @classmethod
+    def empty(cls, embedding_dimension: int, embedding_dtype: str) -> "_Segment":
+        segment = cls(
+            np.empty(0, dtype=np.int64),
+            np.empty((0, embedding_dimension), dtype=embedding_dtype),
+            np.empty(0, dtype=np.float32),
+            np.empty(0, dtype=METADATA_DTYPE),
+        )
+        return segment
+
+    def append(
+        self, ids: np.ndarray, codes: np.ndarray, scales: np.ndarray, meta: np.ndarray
+    ) -> None:
+        """Append entities, growing the columns geometrically"""
+        n = self.count + len(ids)
+        if n > len(self.ids):
+            capacity = max(n, 2 * len(self.ids), 1024)
+            for name in ("ids", "codes", "scales", "meta", "alive"):
+                old = getattr(self, name)
+                new = np.zeros((capacity, *old.shape[1:]), dtype=old.dtype)
+                new[: self.count] = old[: self.count]
+                setattr(self, name, new)
+        self.ids[self.count : n] = ids
+        self.codes[self.count : n] = codes
+        self.scales[self.count : n] = scales
+        self.meta[self.count : n] = meta
+        self.alive[self.count : n] = True
+        self.count = n
+
+
+class NumpyLocalServer:
+    """An in-memory vector store on numpy arrays, persisted in local files
+
+    Embeddings are kept in the compact storage dtype, and scored block by block,
+    so the whole matrix is never copied into float32.
+
+    Entities live in segments. A snapshot file holds the base segment and the
+    delta segments appended by `snapshot`, which are memory-mapped at startup,
+    so the store serves at once while pages are faulted in lazily. Changes
+    after the last snapshot are replayed from an append-only log file.
+
+    Every change of the segments publishes a new tuple of them, so searches
+    read a consistent view without the lock. The index from ID to row is
+    built on the first write, or `get_metadata`, after startup, which takes
+    about 1 s per million entities under the lock.
+
+    >>> # doc test
+    >>> svr = NumpyLocalServer(Path("/tmp/test_numpy.vec"), 4, embedding_dtype="int8")
+    >>> svr.size()
+    0
+    >>> x = np.eye(4, dtype=np.float32)
+    >>> ids = svr.insert_batch(x[:3], [10, 11, 12])
+    >>> svr.snapshot()
+    >>> id = svr.insert(x[3])
+    >>> svr.size()
+    4
+    >>> [r[0] for r in svr.search(x[1], top_k=2)]
+    [11]
+    >>> id_wide = svr.insert(x[1], metadata={"width": 640, "source": "coco"})
+    >>> [r[0] for r in svr.search(x[1], top_k=2, filter='width >= 640')] == [id_wide]
+    True
+    >>> hits = svr.search(x[1], top_k=3, distance_threshold=-1, candidate_ids=np.array([10, 12]))
+    >>> sorted(r[0] for r in hits)
+    [10, 12]
+    >>> svr.get_metadata([id_wide])[0]["source"]
+    'coco'
+    >>> svr.delete(id_wide)
+    >>> svr.delete(11)
+    >>> svr.size(), svr.deleted_count()
+    (3, 2)
+    >>> svr.snapshot()
+    >>> svr = NumpyLocalServer(Path("/tmp/test_numpy.vec"), 4, embedding_dtype="int8")
+    >>> sorted(svr.all_id()) == sorted([10, 12, id])
+    True
+    >>> svr.compact()
+    >>> svr.deleted_count()
+    0
+    >>> svr = NumpyLocalServer(Path("/tmp/test_numpy.vec"), 4, embedding_dtype="int8")
+    >>> sorted(svr.all_id()) == sorted([10, 12, id])
+    True
+    >>> os.unlink("/tmp/test_numpy.vec")
+    >>> os.unlink("/tmp/test_numpy.snap")
+    """
+
+    MAGIC = b"ISDVEC03"
+    SEGMENT_MAGIC = b"ISDSEG01"
+    SEGMENT_HEADER_DTYPE = np.dtype(
+        [
+            ("magic", "S8"),
+            ("count", "<u8"),
+            ("deleted_count", "<u8"),
+            ("dimension", "<u8"),
+            ("dtype", "S8"),
+            # the log records before this offset are in the snapshot
+            ("log_generation", "<u8"),
+            ("log_offset", "<u8"),
+            # CRC-32 of the columns, 0 if not recorded
+            ("checksum", "<u8"),
+        ]
+    )
+    ALIGNMENT = 64
+    BLOCK_SIZE = 1024
+    # an automatic snapshot is taken when the latest segment grows to this size
+    SEGMENT_SIZE = 65536
+
+    def __init__(
+        self,
+        database_fpath: Path,
+        embedding_dimension: int,
+        embedding_dtype: str = "float32",
+    ) -> None:
+        """Initialize the in-memory store, from its snapshot and log files if exist
+
+        Args:
+            database_fpath (Path): file path of the log file, the snapshot file has the suffix ".snap" instead
+            embedding_dimension (int): dimension of the embedding from the embedding server
+            embedding_dtype (str, optional): storage dtype of the embeddings, one of `EMBEDDING_DTYPES`. Defaults to "float32"
+        """
+        assert (
+            embedding_dtype in EMBEDDING_DTYPES
+        ), f"Invalid embedding dtype: {embedding_dtype}"
+        self.database_fpath = Path(database_fpath)
+        self.snapshot_fpath = self.database_fpath.with_suffix(".snap")
+        self.embedding_dimension = embedding_dimension
+        self.embedding_dtype = embedding_dtype
+        # IDs are always given by the caller or generated here
+        self.auto_id = False
+        self._last_id = 0
+
+        # one record per insert (op=1) or delete (op=0)
+        self._record_dtype = np.dtype(
+            [
+                ("op", "u1"),
+                ("id", "<i8"),
+                ("scale", "<f4"),
+                ("meta", METADATA_DTYPE),
+                ("code", embedding_dtype, (embedding_dimension,)),
+            ]
+        )
+        self._log_header_dtype = np.dtype(
+            [("magic", "S8"), ("itemsize", "<u8"), ("generation", "<u8")]
+        )
+
+        # `_lock` guards changes, `_snapshot_lock` serializes snapshot writers
+        self._lock = threading.RLock()
+        self._snapshot_lock = threading.Lock()
+        # the last segment is the latest one, which grows with inserts
+        self._segments: tuple[_Segment, ...] = (
+            _Segment.empty(embedding_dimension, embedding_dtype),
+        )
+        # IDs deleted since the last snapshot, to be written into the next one
+        self._deleted: list[int] = []
+        self._count = 0
+        # ID to its segment and row, built on the first write so that startup stays fast
+        self._rows: dict[int, tuple[_Segment, int]] | None = None
+        # an automatic snapshot is scheduled, but has not frozen the latest segment yet
+        self._snapshot_pending = False
+
+        logger.info(f"Initialize in-memory database with local file {database_fpath}")
+        os.makedirs(self.database_fpath.parent, exist_ok=True)
+        segments, self._count, log_generation, log_offset = self._load_snapshot()
+        self._segments = (*segments, self._active)
+        self._replay(log_generation, log_offset)
+
+    @property
+    def _active(self) -> _Segment:
+        """The latest segment, which inserts are appended to"""
+        return self._segments[-1]
+
+    def _log_header(self, generation: int) -> bytes:
+        header = np.array(
+            [(self.MAGIC, self._record_dtype.itemsize, generation)],
+            dtype=self._log_header_dtype,
+        )
+        return header.tobytes()
+
+    def _load_snapshot(self) -> tuple[list[_Segment], int, int, int]:
+        """Memory-map the segments of the snapshot file
+
+        Returns:
+            tuple[list[_Segment], int, int, int]: segments, number of live entities in them, and generation of the log file and offset in it, where the replay starts
+        """
+        segments = []
+        alive_count = 0
+        log_generation, log_offset = 0, self._log_header_dtype.itemsize
+        if not self.snapshot_fpath.exists() or self.snapshot_fpath.stat().st_size == 0:
+            return segments, alive_count, log_generation, log_offset
+
+        mm = np.memmap(self.snapshot_fpath, dtype=np.uint8, mode="r")
+        header_size = self.SEGMENT_HEADER_DTYPE.itemsize
+        deleted = []
+        offset = 0
+        while offset + header_size <= len(mm):
+            header = mm[offset : offset + header_size].view(self.SEGMENT_HEADER_DTYPE)[0]
+            assert (
+                header["magic"] == self.SEGMENT_MAGIC
+                and header["dimension"] == self.embedding_dimension
+                and header["dtype"].decode() == self.embedding_dtype
+            ), f"Snapshot {self.snapshot_fpath} does not match {self.embedding_dtype} embeddings of dimension {self.embedding_dimension}"
+            count, deleted_count = int(header["count"]), int(header["deleted_count"])
+            layout = self._segment_layout(count, deleted_count)
+            end = offset + header_size + sum(padded for *_, padded in layout)
+            if end > len(mm):
+                break
+            # every segment is synced before the next one is appended, only the last one can be torn
+            checksum = int(header["checksum"])
+            if end == len(mm) and checksum != 0:
+                body = mm[offset + header_size : end]
+                if zlib.crc32(body) != checksum:
+                    break
+
+            columns = {}
+            start = offset + header_size
+            for name, dtype, shape, nbytes, padded in layout:
+                columns[name] = mm[start : start + nbytes].view(dtype).reshape(shape)
+                start += padded
+            segments.append(
+                _Segment(
+                    columns["ids"], columns["codes"], columns["scales"], columns["meta"]
+                )
+            )
+            deleted.append(columns["deleted"])
+            log_generation, log_offset = header["log_generation"], header["log_offset"]
+            offset = end
+        if offset < len(mm):
+            # a torn segment or header at the end, its changes are still in the log,
+            # cut it off so that the next segment is appended after the last whole one
+            logger.warning(f"Ignore a truncated segment in {self.snapshot_fpath}")
+            os.truncate(self.snapshot_fpath, offset)
+
+        # the deleted IDs of a segment refer to the rows of the earlier segments
+        for i, segment in enumerate(segments):
+            later = [ids for ids in deleted[i + 1 :] if len(ids) > 0]
+            if len(later) > 0:
+                segment.alive &= ~np.isin(segment.ids, np.concatenate(later))
+            alive_count += int(segment.alive.sum())
+            if segment.count > 0:
+                self._last_id = max(self._last_id, int(segment.ids.max()))
+        logger.info(
+            f"Map {len(segments)} segments of {alive_count} entities from {self.snapshot_fpath}"
+        )
+        return segments, alive_count, int(log_generation), int(log_offset)
+
+    def _segment_layout(
+        self, count: int, deleted_count: int
+    ) -> list[tuple[str, np.dtype, tuple, int, int]]:
+        """Get the columns of a segment in the snapshot file
+
+        Args:
+            count (int): number of entities in the segment
+            deleted_count (int): number of IDs deleted since the previous segment
+
+        Returns:
+            list[tuple[str, np.dtype, tuple, int, int]]: name, dtype, shape, size, and size padded for alignment of each column
+        """
+        columns = [
+            ("ids", np.dtype("<i8"), (count,)),
+            ("scales", np.dtype("<f4"), (count,)),
+            ("meta", METADATA_DTYPE, (count,)),
+            ("codes", np.dtype(self.embedding_dtype), (count, self.embedding_dimension)),
+            ("deleted", np.dtype("<i8"), (deleted_count,)),
+        ]
+        layout = []
+        for name, dtype, shape in columns:
+            nbytes = dtype.itemsize * int(np.prod(shape))
+            layout.append((name, dtype, shape, nbytes, nbytes + -nbytes % self.ALIGNMENT))
+        return layout
+
+    def _write_segment(
+        self,
+        fpath: Path,
+        mode: str,
+        count: int,
+        columns: dict[str, Iterable[np.ndarray]],
+        deleted: list[int],
+        log_generation: int,
+        log_offset: int,
+    ) -> None:
+        """Write a segment into the snapshot file
+
+        Args:
+            fpath (Path): file path to write to
+            mode (str): "ab" to append a delta segment, or "wb" to write a base segment
+            count (int): number of entities in the segment
+            columns (dict[str, Iterable[np.ndarray]]): "ids", "scales", "meta" and "codes" columns, each in chunks
+            deleted (list[int]): IDs deleted since the previous segment
+            log_generation (int): generation of the log file
+            log_offset (int): offset in the log file, the records before it are in the snapshot
+        """
+        header = np.array(
+            [
+                (
+                    self.SEGMENT_MAGIC,
+                    count,
+                    len(deleted),
+                    self.embedding_dimension,
+                    self.embedding_dtype.encode(),
+                    log_generation,
+                    log_offset,
+                    0,
+                )
+            ],
+            dtype=self.SEGMENT_HEADER_DTYPE,
+        )
+        columns = {**columns, "deleted": [np.asarray(deleted, dtype=np.int64)]}
+        # the header is rewritten with the checksum, which append mode does not allow
+        append = mode == "ab" and fpath.exists()
+        with open(fpath, "r+b" if append else "wb") as f:
+            start = f.seek(0, os.SEEK_END)
+            f.write(header.tobytes())
+            checksum = 0
+            for name, dtype, _, nbytes, padded in self._segment_layout(
+                count, len(deleted)
+            ):
+                for chunk in columns[name]:
+                    data = np.ascontiguousarray(chunk, dtype=dtype).tobytes()
+                    checksum = zlib.crc32(data, checksum)
+                    f.write(data)
+                padding = bytes(padded - nbytes)
+                checksum = zlib.crc32(padding, checksum)
+                f.write(padding)
+            header["checksum"] = checksum
+            f.seek(start)
+            f.write(header.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _gather(
+        self,
+        segments: tuple[_Segment, ...],
+        rows: list[np.ndarray],
+        name: str,
+        batch_size: int,
+        max_bytes_per_second: float | None,
+    ) -> Iterable[np.ndarray]:
+        """Gather a column of the given rows of segments in batches
+
+        Args:
+            segments (tuple[_Segment, ...]): segments to read from
+            rows (list[np.ndarray]): rows of each segment
+            name (str): name of the column
+            batch_size (int): number of rows in a batch
+            max_bytes_per_second (float | None): throttle the batches. None means no limit
+
+        Yields:
+            Iterator[np.ndarray]: column of a batch of rows
+        """
+        start = time.monotonic()
+        nbytes = 0
+        for segment, segment_rows in zip(segments, rows):
+            for i in range(0, len(segment_rows), batch_size):
+                # the columns of the latest segment are replaced when it grows
+                chunk = getattr(segment, name)[segment_rows[i : i + batch_size]]
+                yield chunk
+                nbytes += chunk.nbytes
+                if max_bytes_per_second is not None:
+                    budget = nbytes / max_bytes_per_second
+                    time.sleep(max(0.0, budget - (time.monotonic() - start)))
+
+    def _replay(self, log_generation: int, log_offset: int) -> None:
+        """Apply the log records after the snapshot"""
+        self._generation = log_generation
+        header_size = self._log_header_dtype.itemsize
+        if self.database_fpath.exists():
+            with open(self.database_fpath, "rb") as f:
+                header = np.frombuffer(f.read(header_size), dtype=self._log_header_dtype)
+                assert (
+                    len(header) == 1
+                    and header["magic"][0] == self.MAGIC
+                    and header["itemsize"][0] == self._record_dtype.itemsize
+                ), f"Database file {self.database_fpath} does not match {self.embedding_dtype} embeddings of dimension {self.embedding_dimension}"
+                if header["generation"][0] == log_generation:
+                    f.seek(log_offset)
+                    # a torn record at the end of the log is dropped
+                    records = np.fromfile(f, dtype=self._record_dtype)
+                    logger.info(f"Replay {len(records)} records from {self.database_fpath}")
+                    self._apply(records)
+                    return
+                # a log newer than the snapshot was restarted after a compaction, which is lost
+                assert (
+                    header["generation"][0] < log_generation
+                ), f"Snapshot {self.snapshot_fpath} misses the compacted entities of log generation {header['generation'][0]}"
+            # the snapshot was compacted, but the log was not restarted yet
+            logger.warning(f"Discard the stale log file {self.database_fpath}")
+        tmp_fpath = self.database_fpath.with_suffix(".tmp")
+        with open(tmp_fpath, "wb") as f:
+            f.write(self._log_header(log_generation))
+        os.replace(tmp_fpath, self.database_fpath)
+
+    def _apply(self, records: np.ndarray) -> None:
+        """Apply log records to the in-memory segments"""
+        # apply runs of consecutive inserts or deletes in bulk
+        bounds = np.flatnonzero(np.diff(records["op"])) + 1
+        for run in np.split(records, bounds):
+            if len(run) == 0:
+                continue
+            if run["op"][0] == 1:
+                self._append(run["id"], run["code"], run["scale"], run["meta"])
+                self._last_id = max(self._last_id, int(run["id"].max()))
+            else:
+                self._remove(run["id"].tolist())
+
+    def _row_index(self) -> dict[int, tuple[_Segment, int]]:
+        """Get the index from ID to its segment and row, building it if needed"""
+        with self._lock:
+            if self._rows is None:
+                rows = {}
+                for segment in self._segments:
+                    alive = np.flatnonzero(segment.alive[: segment.count])
+                    for row, id in zip(alive.tolist(), segment.ids[alive].tolist()):
+                        rows[id] = (segment, row)
+                self._rows = rows
+            return self._rows
+
+    def _append(
+        self, ids: np.ndarray, codes: np.ndarray, scales: np.ndarray, meta: np.ndarray
+    ) -> None:
+        """Append entities to the latest segment"""
+        start = self._active.count
+        self._active.append(ids, codes, scales, meta)
+        if self._rows is not None:
+            for row, id in enumerate(ids.tolist(), start=start):
+                self._rows[id] = (self._active, row)
+        self._count += len(ids)
+
+    def _remove(self, ids: Iterable[int]) -> None:
+        """Mask deleted entities in their segments"""
+        if self._rows is None:
+            # replaying the log at startup, without building the row index
+            ids = np.asarray(ids, dtype=np.int64)
+            for segment in self._segments:
+                count = segment.count
+                found = np.flatnonzero(
+                    segment.alive[:count] & np.isin(segment.ids[:count], ids)
+                )
+                segment.alive[found] = False
+                self._deleted.extend(segment.ids[found].tolist())
+                self._count -= len(found)
+            return
+        rows = self._rows
+        for id in ids:
+            found = rows.pop(int(id), None)
+            if found is None:
+                continue
+            segment, row = found
+            segment.alive[row] = False
+            self._deleted.append(int(id))
+            self._count -= 1
+
+    def _write(
+        self, op: int, ids: list[int], codes=None, scales=None, meta=None
+    ) -> None:
+        """Append records to the log file"""
+        records = np.zeros(len(ids), dtype=self._record_dtype)
+        records["op"] = op
+        records["id"] = ids
+        if codes is not None:
+            records["code"] = codes
+            records["scale"] = scales
+            records["meta"] = meta
+        with open(self.database_fpath, "ab") as f:
+            f.write(records.tobytes())
+
+    def _next_id(self) -> int:
+        """Generate a new unique ID, see `MilvusLocalServer._next_id`
+
+        Returns:
+            int: unique ID
+        """
+        self._last_id = max(self._last_id + 1, time.time_ns())
+        return self._last_id
+
+    def size(self) -> int:
+        """Get the total number of entities in the database
+
+        Returns:
+            int: number of entities
+        """
+        return self._count
+
+    def deleted_count(self) -> int:
+        """Get the number of deleted entities whose storage is not reclaimed by `compact` yet
+
+        Returns:
+            int: number of entities
+        """
+        segments = self._segments
+        return sum(segment.count for segment in segments) - self._count
+
+    def insert(
+        self,
+        embedding: np.ndarray,
+        id: int | None = None,
+        metadata: dict | None = None,
+    ) -> int:
+        """Insert an embedding into the database
+
+        Args:
+            embedding (np.ndarray): numpy array of the embedding to be inserted
+            id (int | None, optional): ID of the embedding. Defaults to None, which generates a new one
+            metadata (dict | None, optional): scalar metadata of the embedding, see `METADATA_DTYPE`. Defaults to None
+
+        Returns:
+            int: unique ID of the inserted embedding
+        """
+        return self.insert_batch(
+            embedding[np.newaxis],
+            None if id is None else [id],
+            None if metadata is None else [metadata],
+        )[0]
+
+    def insert_batch(
+        self,
+        embeddings: np.ndarray,
+        ids: list[int] | None = None,
+        metadata: list[dict] | None = None,
+    ) -> list[int]:
+        """Insert a batch of embeddings into the database
+
+        Args:
+            embeddings (np.ndarray): numpy array of the embeddings, 2D with shape (batch, embedding dimension)
+            ids (list[int] | None, optional): IDs of the embeddings. Defaults to None, which generates new ones
+            metadata (list[dict] | None, optional): scalar metadata of each embedding, see `METADATA_DTYPE`. Defaults to None
+
+        Returns:
+            list[int]: unique IDs of the inserted embeddings
+        """
+        logger.trace(f"Inserting {len(embeddings)} embeddings {embeddings[0][0]=}")
+        codes, scales = quantize(embeddings, self.embedding_dtype)
+        meta = metadata_array(metadata, len(embeddings))
+        with self._lock:
+            if ids is None:
+                ids = [self._next_id() for _ in embeddings]
+            assert len(ids) == len(embeddings), f"{len(ids)=} != {len(embeddings)=}"
+            rows = self._row_index()
+            assert all(id not in rows for id in ids), f"Duplicated IDs: {ids}"
+            self._last_id = max(self._last_id, *ids)
+
+            self._write(1, ids, codes, scales, meta)
+            self._append(np.asarray(ids, dtype=np.int64), codes, scales, meta)
+            if self._active.count >= self.SEGMENT_SIZE and not self._snapshot_pending:
+                self._snapshot_pending = True
+                threading.Thread(target=self.snapshot, daemon=True).start()
+        return list(ids)
+
+    def _scores(
+        self,
+        segment: _Segment,
+        query: np.ndarray,
+        filter: str = "",
+        candidate_ids: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Score the live entities of a segment matching the filter
+
+        Args:
+            segment (_Segment): segment to be scored
+            query (np.ndarray): numpy array of the query embedding in float32
+            filter (str, optional): filter expression, see `filter_mask`. Defaults to "", which matches all
+            candidate_ids (np.ndarray | None, optional): only score these entities. Defaults to None, which scores all
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: IDs and cosine similarities of the matching entities
+        """
+        # the columns of the latest segment are replaced when it grows
+        count = segment.count
+        ids, codes, scales = segment.ids[:count], segment.codes[:count], segment.scales[:count]
+        mask = segment.alive[:count].copy()
+        if (filter or candidate_ids is not None) and count > 0:
+            if candidate_ids is not None:
+                mask &= np.isin(ids, candidate_ids)
+            if filter:
+                columns = {"id": ids}
+                columns.update({n: segment.meta[n][:count] for n in METADATA_DTYPE.names})
+                mask &= filter_mask(filter, columns)
+            rows = np.flatnonzero(mask)
+        else:
+            # scoring the few deleted rows is cheaper than gathering the live ones
+            rows = None
+
+        n = count if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.float32)
+        for i in range(0, n, self.BLOCK_SIZE):
+            j = min(i + self.BLOCK_SIZE, n)
+            # only one block is converted to float32 at a time for BLAS
+            block = codes[i:j] if rows is None else codes[rows[i:j]]
+            np.matmul(block.astype(np.float32, copy=False), query, out=scores[i:j])
+        if rows is None:
+            scores *= scales
+            return ids[mask], scores[mask]
+        scores *= scales[rows]
+        return ids[rows], scores
+
+    def search(
+        self,
+        embedding: np.ndarray,
+        top_k: int,
+        distance_threshold: float = 0.5,
+        filter: str = "",
+        candidate_ids: np.ndarray | None = None,
+    ) -> list[tuple[int, float]]:
+        """Search for embeddings in the database
+
+        Args:
+            embedding (np.ndarray): numpy array of the embedding to be searched, generated by the embedding server
+            top_k (int): maximum number of results to return
+            distance_threshold (float, optional): threshold of the distance metric. Defaults to 0.5
+            filter (str, optional): filter expression on the metadata, see `filter_mask`. Only the matching entities are scored. Defaults to "", which matches all
+            candidate_ids (np.ndarray | None, optional): only search these entities, e.g. from the tag index. Defaults to None, which searches all
+
+        Returns:
+            list[tuple[int, float]]: list of search results, 1st element is the entity ID, 2nd element is the distance
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        if candidate_ids is not None:
+            candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+        scored = [
+            self._scores(segment, query, filter, candidate_ids)
+            for segment in self._segments
+        ]
+        ids = np.concatenate([ids for ids, _ in scored])
+        scores = np.concatenate([scores for _, scores in scored])
+
+        if top_k < len(scores):
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top = top[scores[top] >= distance_threshold]
+        results = list(zip(ids[top].tolist(), scores[top].tolist()))
+        if len(results) < top_k:
+            logger.warning(f"No enough results found for {embedding[0]=}")
         logger.trace(f"{top_k=} {distance_threshold=} {results=}")
         return results
 
@@ -153,7 +1152,221 @@ class MilvusLocalServer:
         Args:
             id (int): ID of the entity to be deleted
         """
-        self.client.delete(self.collection_name, ids=[id])
+        self.delete_batch([id])
+
+    def delete_batch(self, ids: list[int]) -> None:
+        """Delete a batch of entities from the database use their IDs
+
+        Args:
+            ids (list[int]): IDs of the entities to be deleted
+        """
+        with self._lock:
+            self._write(0, ids)
+            self._row_index()
+            self._remove(ids)
+
+    def snapshot(self) -> None:
+        """Append the changes since the last snapshot to the snapshot file as a delta segment
+
+        The latest segment is frozen under the lock, and written afterwards,
+        so that inserts and deletes are not blocked meanwhile.
+        """
+        with self._snapshot_lock:
+            with self._lock:
+                self._snapshot_pending = False
+                frozen, deleted = self._active, self._deleted
+                if frozen.count == 0 and len(deleted) == 0:
+                    return
+                log_generation = self._generation
+                log_offset = self.database_fpath.stat().st_size
+                self._segments = (
+                    *self._segments,
+                    _Segment.empty(self.embedding_dimension, self.embedding_dtype),
+                )
+                self._deleted = []
+
+            # rows deleted from now on are in the deleted IDs of the next segment
+            alive = np.flatnonzero(frozen.alive[: frozen.count])
+            columns = {
+                name: [getattr(frozen, name)[alive]]
+                for name in ("ids", "scales", "meta", "codes")
+            }
+            self._write_segment(
+                self.snapshot_fpath,
+                "ab",
+                len(alive),
+                columns,
+                deleted,
+                log_generation,
+                log_offset,
+            )
+        logger.info(
+            f"Snapshot {len(alive)} entities and {len(deleted)} deletions into {self.snapshot_fpath}"
+        )
+
+    def compact(
+        self, batch_size: int = 65536, max_bytes_per_second: float | None = None
+    ) -> None:
+        """Reclaim the storage of deleted entities
+
+        All live entities are written in batches as the base segment of a new
+        snapshot file, without holding the lock, so that inserts and deletes
+        go on meanwhile. The changes made meanwhile are appended as a delta
+        segment under the lock, then the new snapshot file is memory-mapped
+        and the log file is restarted.
+
+        Args:
+            batch_size (int, optional): number of entities written at a time. Defaults to 65536
+            max_bytes_per_second (float | None, optional): throttle the writes to protect the disk. Defaults to None, which means no limit
+        """
+        assert batch_size > 0, f"Invalid batch size: {batch_size}"
+        columns = ("ids", "scales", "meta", "codes")
+        log_offset = self._log_header_dtype.itemsize
+        tmp_fpath = self.snapshot_fpath.with_suffix(".tmp")
+        # snapshots are held back, so the segments only change by inserts and deletes
+        with self._snapshot_lock:
+            with self._lock:
+                segments = self._segments
+                active_count = self._active.count
+                deleted_count = len(self._deleted)
+                rows = [np.flatnonzero(s.alive[: s.count]) for s in segments]
+            generation = self._generation + 1
+            self._write_segment(
+                tmp_fpath,
+                "wb",
+                sum(len(r) for r in rows),
+                {
+                    name: self._gather(
+                        segments, rows, name, batch_size, max_bytes_per_second
+                    )
+                    for name in columns
+                },
+                [],
+                generation,
+                log_offset,
+            )
+
+            with self._lock:
+                active = self._active
+                assert active is segments[-1], "Segments changed during compaction"
+                # inserts and deletes since the base segment was frozen
+                delta = active_count + np.flatnonzero(
+                    active.alive[active_count : active.count]
+                )
+                deleted = self._deleted[deleted_count:]
+                self._write_segment(
+                    tmp_fpath,
+                    "ab",
+                    len(delta),
+                    {name: [getattr(active, name)[delta]] for name in columns},
+                    deleted,
+                    generation,
+                    log_offset,
+                )
+                os.replace(tmp_fpath, self.snapshot_fpath)
+                self._generation = generation
+
+                # the log is stale from now on, it is discarded at startup if a crash happens here
+                tmp_fpath = self.database_fpath.with_suffix(".tmp")
+                with open(tmp_fpath, "wb") as f:
+                    f.write(self._log_header(self._generation))
+                os.replace(tmp_fpath, self.database_fpath)
+
+                # the new segments are published at once, searches never see a partial state
+                segments, count, *_ = self._load_snapshot()
+                self._segments = (
+                    *segments,
+                    _Segment.empty(self.embedding_dimension, self.embedding_dtype),
+                )
+                self._deleted = []
+                self._count = count
+                self._rows = None
+        logger.info(f"Compacted {self.snapshot_fpath} to {self._count} entities")
+
+    def get_metadata(self, ids: list[int]) -> list[dict]:
+        """Get the metadata of entities
+
+        Args:
+            ids (list[int]): IDs of the entities
+
+        Returns:
+            list[dict]: metadata of each entity, in the same order as the IDs
+        """
+        rows = self._row_index()
+        meta = np.array(
+            [rows[id][0].meta[rows[id][1]] for id in ids], dtype=METADATA_DTYPE
+        )
+        return metadata_dicts(meta)
+
+    def all_id(self) -> Iterable[int]:
+        """Get all entities' IDs
+
+        Yields:
+            Iterator[int]: entity ID in iterator form
+        """
+        for segment in self._segments:
+            count = segment.count
+            yield from segment.ids[:count][segment.alive[:count]].tolist()
+
+
+def measure_recall(
+    embeddings: np.ndarray, queries: np.ndarray, embedding_dtype: str, top_k: int = 10
+) -> float:
+    """Measure the recall@k of quantized storage against exact float32 search
+
+    >>> rng = np.random.default_rng(0)
+    >>> x = rng.standard_normal((1000, 64)).astype(np.float32)
+    >>> x /= np.linalg.norm(x, axis=1, keepdims=True)
+    >>> measure_recall(x, x[:10], "float32")
+    1.0
+
+    Args:
+        embeddings (np.ndarray): numpy array of normalized embeddings, 2D with shape (count, embedding dimension)
+        queries (np.ndarray): numpy array of normalized query embeddings, 2D with shape (count, embedding dimension)
+        embedding_dtype (str): storage dtype, one of `EMBEDDING_DTYPES`
+        top_k (int, optional): number of results per query. Defaults to 10
+
+    Returns:
+        float: fraction of the exact top-k results found by the quantized search
+    """
+    codes, scales = quantize(embeddings, embedding_dtype)
+    exact = np.argsort(-(embeddings @ queries.T), axis=0)[:top_k]
+    scores = (codes.astype(np.float32) @ queries.T) * scales[:, np.newaxis]
+    approx = np.argsort(-scores, axis=0)[:top_k]
+    hits = sum(
+        len(np.intersect1d(exact[:, i], approx[:, i])) for i in range(len(queries))
+    )
+    return hits / (top_k * len(queries))
+
+
+def create_database_server(
+    config: Config, embedding_dimension: int, auto_id: bool = True
+) -> MilvusLocalServer | NumpyLocalServer:
+    """Create the database server according to the configuration
+
+    Args:
+        config (Config): configuration object, see `config.py`
+        embedding_dimension (int): dimension of the embedding from the embedding server
+        auto_id (bool, optional): let the database assign IDs, see `MilvusLocalServer`. Defaults to True
+
+    Returns:
+        MilvusLocalServer | NumpyLocalServer: database server
+    """
+    if not config.use_local_database:
+        raise ValueError("Only support local database for now")
+    if config.use_milvus:
+        if config.embedding_dtype != "float32":
+            raise ValueError(
+                f"Milvus Lite does not support {config.embedding_dtype} embeddings, use the in-memory database"
+            )
+        return MilvusLocalServer(
+            config.local_database_fpath, embedding_dimension, auto_id=auto_id
+        )
+    return NumpyLocalServer(
+        config.local_database_fpath,
+        embedding_dimension,
+        embedding_dtype=config.embedding_dtype,
+    )
 
 
 if __name__ == "__main__":
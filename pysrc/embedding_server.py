@@ -1,11 +1,10 @@
 from __future__ import annotations
 
-import torch
 import numpy as np
 import open_clip
-from PIL import Image
-
+import torch
 from loguru import logger
+from PIL import Image
 
 
 class OpenCLIPEmbeddingServer:
@@ -28,17 +27,28 @@ class OpenCLIPEmbeddingServer:
     True
     >>> emb0.dtype
     dtype('float32')
+    >>> svr = OpenCLIPEmbeddingServer(embedding_dtype="float16")
+    >>> svr.generate_embedding_for_text("Hello!").dtype
+    dtype('float16')
     """
 
     def __init__(
-        self, model_name: tuple[str, str] = ("ViT-L-14-336-quickgelu", "openai")
+        self,
+        model_name: tuple[str, str] = ("ViT-L-14-336-quickgelu", "openai"),
+        embedding_dtype: str = "float32",
     ):
         """Initialize OpenCLIP embedding server, hosting a multimodal model
 
         Args:
             model_name (tuple[str, str], optional): prtrained model name and author. Defaults to ("ViT-L-14-336-quickgelu", "openai").
+            embedding_dtype (str, optional): dtype of the output embeddings, "float32" or "float16", which halves the copies from the device. Defaults to "float32".
         """
         self.model_name = model_name
+        assert embedding_dtype in (
+            "float32",
+            "float16",
+        ), f"Invalid embedding dtype: {embedding_dtype}"
+        self.embedding_dtype = getattr(torch, embedding_dtype)
         assert (
             self.model_name in open_clip.list_pretrained()
         ), f"Invalid model name: {model_name}"
@@ -84,7 +94,25 @@ class OpenCLIPEmbeddingServer:
         """
         with torch.inference_mode():
             pp = self.preprocess(Image.fromarray(image)).unsqueeze(0).to(self.device)
-            e = self.model.encode_image(pp, normalize=True).squeeze().cpu().numpy()
+            e = self.model.encode_image(pp, normalize=True).squeeze()
+            e = e.to(self.embedding_dtype).cpu().numpy()
+        return e
+
+    def generate_embeddings_for_images(self, images: list[np.ndarray]) -> np.ndarray:
+        """Generate embeddings for a batch of images in one forward pass
+
+        Args:
+            images (list[np.ndarray]): numpy arrays of the images, each 3D with shape (height, width, channel), must be uint8
+
+        Returns:
+            np.ndarray: numpy array of the embeddings, 2D with shape (len(images), embedding dimension)
+        """
+        with torch.inference_mode():
+            pp = torch.stack(
+                [self.preprocess(Image.fromarray(image)) for image in images]
+            ).to(self.device)
+            e = self.model.encode_image(pp, normalize=True)
+            e = e.to(self.embedding_dtype).cpu().numpy()
         return e
 
     def generate_embedding_for_text(self, text: str) -> np.ndarray:
@@ -98,7 +126,23 @@ class OpenCLIPEmbeddingServer:
         """
         with torch.inference_mode():
             t = self.tokenizer([text]).to(self.device)
-            e = self.model.encode_text(t, normalize=True).squeeze().cpu().numpy()
+            e = self.model.encode_text(t, normalize=True).squeeze()
+            e = e.to(self.embedding_dtype).cpu().numpy()
+        return e
+
+    def generate_embeddings_for_texts(self, texts: list[str]) -> np.ndarray:
+        """Generate embeddings for a batch of text strings in one forward pass
+
+        Args:
+            texts (list[str]): text strings, only support English for now
+
+        Returns:
+            np.ndarray: numpy array of the embeddings, 2D with shape (len(texts), embedding dimension)
+        """
+        with torch.inference_mode():
+            t = self.tokenizer(texts).to(self.device)
+            e = self.model.encode_text(t, normalize=True)
+            e = e.to(self.embedding_dtype).cpu().numpy()
         return e
 
 
@@ -11,24 +11,41 @@ from loguru import logger
 server = BackendServer(config)
 
 
+PAGE_SIZE = 16
+
+
 # search function for the "Search" button
-def search(text_input, image_input):
-    logger.debug(f"{text_input=} {image_input=}")
+def search(text_input, image_input, filter_input):
+    logger.debug(f"{text_input=} {image_input=} {filter_input=}")
     if image_input is not None:
         # search with image
         p = Path(image_input)
         assert p.is_file(), f"Invalid image file path: {p}"
-        ids = server.search_with_image(p, top_k=16)
+        ids, cursor = server.paged_search_with_image(
+            p, top_k=PAGE_SIZE, filter=filter_input
+        )
     elif text_input:
         # search with text
-        ids = server.search_with_text(text_input, top_k=16)
+        ids, cursor = server.paged_search_with_text(
+            text_input, top_k=PAGE_SIZE, filter=filter_input
+        )
     else:
         logger.error("Invalid input: both text and image are empty")
-        return []
+        return [], [], None, gr.update(visible=False)
 
     results = [server.get_image_uri(id) for id in ids]
     logger.debug(f"Search with image: {results=}")
-    return results
+    return results, results, cursor, gr.update(visible=cursor is not None)
+
+
+# load more function for the "Load more" button, served from the cached search results
+def load_more(results, cursor):
+    if cursor is None:
+        return results, results, None, gr.update(visible=False)
+    ids, cursor = server.load_more(cursor, top_k=PAGE_SIZE)
+    results = results + [server.get_image_uri(id) for id in ids]
+    logger.debug(f"Load more: {ids=}")
+    return results, results, cursor, gr.update(visible=cursor is not None)
 
 
 # Gradio Interface
@@ -41,6 +58,10 @@ with gr.Blocks() as demo:
             label="Text Query", placeholder="Enter your search query here..."
         )
         image_input = gr.Image(label="Upload Image", type="filepath")
+    filter_input = gr.Textbox(
+        label="Filter",
+        placeholder='Optional, e.g. width >= 640 and source == "coco-val2017"',
+    )
 
     search_button = gr.Button("Search")
     results_gallery = gr.Gallery(
@@ -51,8 +72,22 @@ with gr.Blocks() as demo:
         show_label=True,
     )
 
+    load_more_button = gr.Button("Load more", visible=False)
+    # image URIs shown in the gallery, and the cursor of the next page
+    results_state = gr.State([])
+    cursor_state = gr.State(None)
+
     # Define the functionality of the search button
-    search_button.click(search, [text_input, image_input], results_gallery)
+    search_button.click(
+        search,
+        [text_input, image_input, filter_input],
+        [results_gallery, results_state, cursor_state, load_more_button],
+    )
+    load_more_button.click(
+        load_more,
+        [results_state, cursor_state],
+        [results_gallery, results_state, cursor_state, load_more_button],
+    )
 
 # Launch the app
 demo.launch(allowed_paths=[str(Path(__file__).parent.parent / "data")])
@@ -1,3 +1,4 @@
+import itertools
 import os
 from pathlib import Path
 from typing import Iterable
@@ -29,6 +30,20 @@ class ImageLocalServer:
     >>> svr.delete(id)
     >>> svr.size()
     0
+    >>> uris = [svr.insert(img, id) for id in range(3)]
+    >>> svr.tombstone([0, 1, 1])
+    >>> svr.size(), svr.has(0), svr.tombstone_count()
+    (1, False, 2)
+    >>> svr.compact(max_count=1)
+    1
+    >>> svr = ImageLocalServer("/tmp/test_images")
+    >>> svr.size(), svr.tombstone_count()
+    (1, 1)
+    >>> svr.compact(max_count=10)
+    1
+    >>> svr.delete(2)
+    >>> svr.size(), svr.tombstone_count()
+    (0, 0)
     """
 
     def __init__(self, root_dpath: str):
@@ -42,9 +57,20 @@ class ImageLocalServer:
         assert self.root_dpath.is_dir(), f"Invalid directory: {root_dpath}"
         logger.info(f"Image root directory = {self.root_dpath}")
 
-        self._all_fpaths = list(self.root_dpath.glob("*.png"))
+        # keyed by ID, so lookups and deletions are O(1)
+        self._all_fpaths = {int(p.stem): p for p in self.root_dpath.glob("*.png")}
         logger.info(f"Found {len(self._all_fpaths)} images")
 
+        # IDs deleted but whose files are not removed yet, see `tombstone`
+        self._tombstones_fpath = self.root_dpath / "tombstones.bin"
+        self._tombstones: set[int] = set()
+        if self._tombstones_fpath.exists():
+            ids = np.fromfile(self._tombstones_fpath, dtype="<i8").tolist()
+            self._tombstones = {id for id in ids if id in self._all_fpaths}
+            for id in self._tombstones:
+                del self._all_fpaths[id]
+            logger.info(f"Found {len(self._tombstones)} deleted images to be removed")
+
     def size(self) -> int:
         """Get the number of images on the server
 
@@ -62,8 +88,7 @@ class ImageLocalServer:
         Returns:
             bool: True if the image exists
         """
-        p = self.root_dpath / f"{id}.png"
-        return p in self._all_fpaths
+        return id in self._all_fpaths
 
     def get_uri(self, id: int) -> str:
         """Get the URI of the image, which is the file path
@@ -103,7 +128,7 @@ class ImageLocalServer:
 
         uri = self.get_uri(id)
         cv2.imwrite(str(uri), image)
-        self._all_fpaths.append(Path(uri))
+        self._all_fpaths[id] = Path(uri)
         logger.trace(f"Inserted image: {uri}, count = {self.size()}")
         return str(uri)
 
@@ -114,11 +139,52 @@ class ImageLocalServer:
             id (int): image unique ID
         """
         assert self.has(id), f"Image not found: {id=}"
-        p = Path(self.get_uri(id))
+        p = self._all_fpaths.pop(id)
         p.unlink()
-        self._all_fpaths.remove(p)
         logger.trace(f"Deleted image: {p}, count = {self.size()}")
 
+    def tombstone(self, ids: list[int]) -> None:
+        """Delete images by IDs at once, but leave removing the files to `compact`
+
+        Args:
+            ids (list[int]): image unique IDs
+        """
+        ids = list(dict.fromkeys(ids))
+        for id in ids:
+            assert self.has(id), f"Image not found: {id=}"
+        with open(self._tombstones_fpath, "ab") as f:
+            f.write(np.asarray(ids, dtype="<i8").tobytes())
+        for id in ids:
+            del self._all_fpaths[id]
+        self._tombstones.update(ids)
+        logger.trace(f"Tombstoned {len(ids)} images, count = {self.size()}")
+
+    def tombstone_count(self) -> int:
+        """Get the number of deleted images whose files are not removed yet
+
+        Returns:
+            int: number of images
+        """
+        return len(self._tombstones)
+
+    def compact(self, max_count: int) -> int:
+        """Remove the files of deleted images, see `tombstone`
+
+        Args:
+            max_count (int): maximum number of files to remove
+
+        Returns:
+            int: number of files removed
+        """
+        ids = list(itertools.islice(self._tombstones, max_count))
+        for id in ids:
+            Path(self.get_uri(id)).unlink(missing_ok=True)
+        self._tombstones.difference_update(ids)
+        if len(self._tombstones) == 0:
+            self._tombstones_fpath.unlink(missing_ok=True)
+        logger.trace(f"Removed {len(ids)} images, {self.tombstone_count()} left")
+        return len(ids)
+
     def get(self, id: int) -> np.ndarray:
         """Get the image from the server by ID
 
@@ -131,14 +197,25 @@ class ImageLocalServer:
         assert self.has(id), f"Image not found: {id=}"
         return cv2.imread(self.get_uri(id))
 
+    def get_batch(self, ids: list[int]) -> list[np.ndarray | None]:
+        """Get a batch of images from the server by IDs, without holding writers back
+
+        Args:
+            ids (list[int]): image IDs
+
+        Returns:
+            list[np.ndarray | None]: numpy arrays of the images, None for the images deleted meanwhile
+        """
+        # a file removed after the check reads as None
+        return [cv2.imread(self.get_uri(id)) if self.has(id) else None for id in ids]
+
     def all_uri(self) -> Iterable[str]:
         """Get all images' URIs, which are the file paths
 
         Yields:
             Iterator[str]: file path of the image in iterator form
         """
-        for uri in map(str, self._all_fpaths):
-            yield uri
+        yield from map(str, list(self._all_fpaths.values()))
 
     def all_id(self) -> Iterable[int]:
         """Get all images' IDs
@@ -146,8 +223,7 @@ class ImageLocalServer:
         Yields:
             Iterator[int]: image ID in iterator form
         """
-        for p in self._all_fpaths:
-            yield int(p.stem)
+        yield from list(self._all_fpaths)
 
 
 if __name__ == "__main__":
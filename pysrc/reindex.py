@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import sys
+import threading
+import time
+from collections.abc import Callable
+
+from config import Config, create_config
+from database_server import (
+    MilvusLocalServer,
+    NumpyLocalServer,
+    create_database_server,
+)
+from embedding_server import OpenCLIPEmbeddingServer
+from image_server import ImageLocalServer
+from loguru import logger
+
+
+class ReindexJob:
+    """Re-embed the stored images with another model into a shadow database
+
+    The shadow database is the database file of the target model, and it keeps
+    the same IDs as the images on the image server. The job is resumable: every
+    pass only embeds the images that are not in the shadow database yet, and
+    drops the entries of images that were deleted meanwhile.
+    """
+
+    def __init__(
+        self,
+        image_server: ImageLocalServer,
+        config: Config,
+        batch_size: int = 32,
+        max_images_per_second: float | None = None,
+        lock: threading.RLock | None = None,
+        metadata_server: MilvusLocalServer | NumpyLocalServer | None = None,
+    ):
+        """Initialize the re-indexing job
+
+        Args:
+            image_server (ImageLocalServer): image server holding the images to be re-embedded
+            config (Config): configuration of the target model, see `config.py`
+            batch_size (int, optional): number of images embedded in one forward pass. Defaults to 32
+            max_images_per_second (float | None, optional): throttle the job to protect live queries. Defaults to None, which means no limit
+            lock (threading.RLock | None, optional): lock held by the writers of the image server, only while the embeddings are inserted. Defaults to None
+            metadata_server (MilvusLocalServer | NumpyLocalServer | None, optional): current database to copy the image metadata from, otherwise only the image sizes are kept. Defaults to None
+        """
+        assert batch_size > 0, f"Invalid batch size: {batch_size}"
+        self.image_server = image_server
+        self.config = config
+        self.batch_size = batch_size
+        self.max_images_per_second = max_images_per_second
+        self._lock = lock if lock is not None else threading.RLock()
+        self.metadata_server = metadata_server
+
+        logger.info(f"Initialize shadow embedding server {config.open_clip_model_name}")
+        self.embedding_server = OpenCLIPEmbeddingServer(
+            config.open_clip_model_name,
+            "float32" if config.embedding_dtype == "float32" else "float16",
+        )
+
+        logger.info(f"Initialize shadow database server {config.local_database_fpath}")
+        self.database_server = create_database_server(
+            config, self.embedding_server.get_embedding_dimension(), auto_id=False
+        )
+        if self.database_server.auto_id:
+            raise ValueError(
+                f"Database {config.local_database_fpath} assigns its own IDs, remove it before re-indexing"
+            )
+
+        self.done_count = 0
+        self.pending_count = 0
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def run(self, throttle: bool = True) -> int:
+        """Run one pass to catch up with the image server
+
+        Images are read and embedded without the lock, so writers are only held
+        back while the embeddings are inserted.
+
+        Args:
+            throttle (bool, optional): apply `max_images_per_second`. Defaults to True
+
+        Returns:
+            int: number of images embedded in this pass
+        """
+        image_ids = set(self.image_server.all_id())
+        shadow_ids = set(self.database_server.all_id())
+
+        stale_ids = list(shadow_ids - image_ids)
+        if len(stale_ids) > 0:
+            logger.info(f"Drop {len(stale_ids)} deleted images from shadow database")
+            self.database_server.delete_batch(stale_ids)
+
+        pending_ids = sorted(image_ids - shadow_ids)
+        self.pending_count = len(pending_ids)
+        logger.info(f"Re-embed {self.pending_count} images")
+
+        count = 0
+        for i in range(0, len(pending_ids), self.batch_size):
+            if self._stop_event.is_set():
+                logger.info("Re-indexing stopped")
+                break
+            start = time.monotonic()
+
+            batch_ids = pending_ids[i : i + self.batch_size]
+            images = self.image_server.get_batch(batch_ids)
+            found = [(id, im) for id, im in zip(batch_ids, images) if im is not None]
+            ids = [id for id, _ in found]
+            if len(ids) > 0:
+                embs = self.embedding_server.generate_embeddings_for_images(
+                    [image for _, image in found]
+                )
+                sizes = [
+                    {"width": image.shape[1], "height": image.shape[0]}
+                    for _, image in found
+                ]
+                with self._lock:
+                    # images can be deleted while they are embedded
+                    keep = [k for k, id in enumerate(ids) if self.image_server.has(id)]
+                    ids = [ids[k] for k in keep]
+                    if self.metadata_server is not None:
+                        metadata = self.metadata_server.get_metadata(ids)
+                    else:
+                        metadata = [sizes[k] for k in keep]
+                    if len(ids) > 0:
+                        self.database_server.insert_batch(embs[keep], ids, metadata)
+            count += len(ids)
+            self.done_count += len(ids)
+            self.pending_count -= len(batch_ids)
+            logger.trace(f"Re-embedded {count} images, {self.pending_count} pending")
+
+            if throttle and self.max_images_per_second is not None:
+                budget = len(ids) / self.max_images_per_second
+                time.sleep(max(0.0, budget - (time.monotonic() - start)))
+        return count
+
+    def start(self, on_caught_up: Callable[[ReindexJob], None] | None = None) -> None:
+        """Run the job in a background thread
+
+        Args:
+            on_caught_up (Callable[[ReindexJob], None] | None, optional): called from the background thread once the shadow database has caught up, e.g. `BackendServer.cutover`. Defaults to None
+        """
+        assert self._thread is None, "Re-indexing job is already started"
+
+        def _target():
+            try:
+                self.run()
+                if on_caught_up is not None and not self._stop_event.is_set():
+                    on_caught_up(self)
+            except Exception:
+                logger.exception("Re-indexing failed, start it again to resume")
+
+        self._thread = threading.Thread(target=_target, name="reindex", daemon=True)
+        self._thread.start()
+
+    def is_running(self) -> bool:
+        """Check if the background thread is running
+
+        Returns:
+            bool: True until the job is caught up, stopped, or failed
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def stop(self) -> None:
+        """Stop the background thread after the current batch, progress is kept in the shadow database"""
+        self._stop_event.set()
+        self.join()
+
+    def join(self) -> None:
+        """Wait for the background thread to finish"""
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    # Pre-build the shadow database offline, the service then only catches up the rest
+    import open_clip
+    from config import config
+
+    assert len(sys.argv) == 3, f"Usage: {sys.argv[0]} <model_name> <model_author>"
+    # the metadata is copied from the current database, the catch-up only embeds missing images
+    metadata_server = None
+    if config.local_database_fpath.exists():
+        metadata_server = create_database_server(
+            config,
+            open_clip.get_model_config(config.open_clip_model_name[0])["embed_dim"],
+        )
+    job = ReindexJob(
+        ImageLocalServer(config.local_image_dpath),
+        create_config(
+            sys.argv[1], sys.argv[2], config.use_milvus, config.embedding_dtype
+        ),
+        metadata_server=metadata_server,
+    )
+    job.run()
+    job.database_server.snapshot()
@@ -0,0 +1,170 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from loguru import logger
+
+
+def score_cutoff(
+    scores: np.ndarray, min_similarity: float = 0.0, margin: float | None = None
+) -> float:
+    """Get the similarity cutoff of search results
+
+    The cutoff is `margin` below the best score, but not below `min_similarity`.
+    A margin of ln(100) / 100 keeps the results whose CLIP zero-shot
+    probability, i.e. softmax of 100 * similarity, is at least 1% of the best
+    one, which does not depend on how many results are fetched.
+
+    >>> # doc test
+    >>> scores = np.array([0.31, 0.30, 0.28, 0.25, 0.20], dtype=np.float32)
+    >>> cutoff = score_cutoff(scores, margin=0.05)
+    >>> int(np.count_nonzero(scores >= cutoff))
+    3
+    >>> score_cutoff(scores, min_similarity=0.29)
+    0.29
+
+    Args:
+        scores (np.ndarray): similarities of the search results, in descending order
+        min_similarity (float, optional): absolute minimum similarity. Defaults to 0.0
+        margin (float | None, optional): maximum distance from the best score. Defaults to None, which means no limit
+
+    Returns:
+        float: minimum similarity of the results to keep
+    """
+    if len(scores) == 0 or margin is None:
+        return min_similarity
+    return max(min_similarity, float(scores[0]) - margin)
+
+
+def next_fetch_size(
+    scores: np.ndarray, cutoff: float, fetched: int, max_candidates: int
+) -> int:
+    """Estimate how many search results to fetch to reach the cutoff
+
+    The scores of the fetched results are extrapolated linearly by rank, down
+    to the cutoff, so that a slowly decaying distribution fetches enough at
+    once instead of doubling step by step. The slope is taken from the second
+    half of the results, since the scores of the best ones drop faster.
+
+    >>> # doc test
+    >>> scores = np.array([1.0, 0.875, 0.75, 0.625], dtype=np.float32)
+    >>> next_fetch_size(scores, 0.0, fetched=4, max_candidates=1000)
+    9
+    >>> next_fetch_size(scores, 0.5, fetched=4, max_candidates=1000)
+    8
+    >>> next_fetch_size(scores, 0.0, fetched=4, max_candidates=6)
+    6
+    >>> next_fetch_size(scores, 0.7, fetched=4, max_candidates=1000)
+    0
+    >>> next_fetch_size(scores, 0.0, fetched=8, max_candidates=1000)
+    0
+
+    Args:
+        scores (np.ndarray): similarities of the fetched results, in descending order
+        cutoff (float): minimum similarity of the results to keep, see `score_cutoff`
+        fetched (int): number of results requested from the database
+        max_candidates (int): maximum number of results to fetch
+
+    Returns:
+        int: number of results to fetch next, 0 if the fetched ones already reach the cutoff
+    """
+    n = len(scores)
+    if n == 0 or n < fetched or n >= max_candidates or scores[-1] < cutoff:
+        # the cutoff, or the end of the database, is within the fetched results
+        return 0
+    size = 2 * n
+    half = n // 2
+    decay = float(scores[half] - scores[-1]) / max(n - 1 - half, 1)
+    if decay > 0:
+        size = max(size, n + int(np.ceil((float(scores[-1]) - cutoff) / decay)))
+    return min(size, max_candidates)
+
+
+class ResultCache:
+    """Least recently used cache of search results, paged by cursors
+
+    A search keeps all its results above the cutoff, so that loading more only
+    reads the next page from the cache, without running the encoder or the
+    search again.
+
+    >>> # doc test
+    >>> cache = ResultCache(max_entries=2)
+    >>> page, cursor = cache.put([5, 4, 3, 2, 1], page_size=2)
+    >>> page
+    [5, 4]
+    >>> page, cursor = cache.page(cursor, page_size=2)
+    >>> page
+    [3, 2]
+    >>> page, cursor = cache.page(cursor, page_size=2)
+    >>> page, cursor
+    ([1], None)
+    >>> _ = cache.put([1], 1), cache.put([2], 1), cache.put([3], 1)
+    >>> len(cache)
+    2
+    """
+
+    def __init__(self, max_entries: int = 64, ttl_seconds: float = 600.0):
+        """Initialize the cache
+
+        Args:
+            max_entries (int, optional): maximum number of cached searches, the least recently used ones are evicted. Defaults to 64
+            ttl_seconds (float, optional): time to keep a search after it was last paged. Defaults to 600.0
+        """
+        assert max_entries > 0, f"Invalid max entries: {max_entries}"
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, tuple[list[int], float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, ids: list[int], page_size: int) -> tuple[list[int], str | None]:
+        """Cache the results of a search, and get its first page
+
+        Args:
+            ids (list[int]): IDs of all the results, best first
+            page_size (int): number of results per page
+
+        Returns:
+            tuple[list[int], str | None]: first page, and the cursor of the next page, None if there is no more
+        """
+        key = uuid.uuid4().hex
+        with self._lock:
+            self._entries[key] = (list(ids), time.monotonic())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return self.page(f"{key}:0", page_size)
+
+    def page(self, cursor: str, page_size: int) -> tuple[list[int], str | None]:
+        """Get a page of the cached results
+
+        Args:
+            cursor (str): cursor returned with the previous page
+            page_size (int): number of results per page
+
+        Returns:
+            tuple[list[int], str | None]: page of results, and the cursor of the next page, None if there is no more
+        """
+        assert page_size > 0, f"Invalid page size: {page_size}"
+        key, _, offset = cursor.partition(":")
+        offset = int(offset)
+        now = time.monotonic()
+        with self._lock:
+            # drop the expired searches, the oldest are first
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if now - oldest[1] <= self.ttl_seconds:
+                    break
+                self._entries.popitem(last=False)
+            if key not in self._entries:
+                logger.warning(f"Search results of cursor {cursor} are expired")
+                return [], None
+            ids, _ = self._entries.pop(key)
+            self._entries[key] = (ids, now)
+
+        end = offset + page_size
+        next_cursor = f"{key}:{end}" if end < len(ids) else None
+        return ids[offset:end], next_cursor
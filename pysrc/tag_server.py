@@ -0,0 +1,254 @@
+import json
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+# the categories of the COCO dataset used by this demo
+COCO_LABELS = (
+    "person", "bicycle", "car", "motorcycle", "airplane", "bus", "train", "truck",
+    "boat", "traffic light", "fire hydrant", "stop sign", "parking meter", "bench",
+    "bird", "cat", "dog", "horse", "sheep", "cow", "elephant", "bear", "zebra",
+    "giraffe", "backpack", "umbrella", "handbag", "tie", "suitcase", "frisbee",
+    "skis", "snowboard", "sports ball", "kite", "baseball bat", "baseball glove",
+    "skateboard", "surfboard", "tennis racket", "bottle", "wine glass", "cup",
+    "fork", "knife", "spoon", "bowl", "banana", "apple", "sandwich", "orange",
+    "broccoli", "carrot", "hot dog", "pizza", "donut", "cake", "chair", "couch",
+    "potted plant", "bed", "dining table", "toilet", "tv", "laptop", "mouse",
+    "remote", "keyboard", "cell phone", "microwave", "oven", "toaster", "sink",
+    "refrigerator", "book", "clock", "vase", "scissors", "teddy bear",
+    "hair drier", "toothbrush",
+)  # fmt: skip
+
+
+class TagLocalServer:
+    """Zero-shot image tagger with an inverted tag index, persisted in a local log file
+
+    Image embeddings are scored against a bank of label prompt embeddings,
+    which is one matrix multiplication per batch, and the top labels are kept
+    as tags of the image.
+
+    >>> # doc test
+    >>> svr = TagLocalServer(Path("/tmp/test_tags.jsonl"), ("cat", "dog", "hot dog"))
+    >>> svr.set_label_embeddings(np.eye(3, 4, dtype=np.float32))
+    >>> tags = svr.tag(np.array([[0.9, 0.1, 0, 0], [0, 0, 1, 0]], dtype=np.float32))
+    >>> tags
+    [['cat'], ['hot dog']]
+    >>> svr.insert_batch([1, 2], tags)
+    >>> svr.insert(3, ["cat", "dog"])
+    >>> sorted(svr.search(["cat"]))
+    [1, 3]
+    >>> sorted(svr.search(["cat", "dog"])), sorted(svr.search(["dog", "hot dog"], match_all=False))
+    ([3], [2, 3])
+    >>> svr.search(["unicorn"])
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown tags: ['unicorn']
+    >>> sorted(svr.match("Two cats and a dog"))
+    ['cat', 'dog']
+    >>> svr.match("hot dogs")
+    ['hot dog']
+    >>> svr.delete(3)
+    >>> svr = TagLocalServer(Path("/tmp/test_tags.jsonl"), ("cat", "dog", "hot dog"))
+    >>> svr.size(), svr.get_tags(2)
+    (2, ['hot dog'])
+    >>> os.unlink("/tmp/test_tags.jsonl")
+    """
+
+    def __init__(
+        self,
+        tag_fpath: Path,
+        labels: tuple[str, ...] = COCO_LABELS,
+        max_tags: int = 3,
+        min_probability: float = 0.1,
+    ):
+        """Initialize tag server, replaying its log file if exists
+
+        Args:
+            tag_fpath (Path): file path of the log file
+            labels (tuple[str, ...], optional): labels to tag images with. Defaults to COCO_LABELS
+            max_tags (int, optional): maximum number of tags per image. Defaults to 3
+            min_probability (float, optional): minimum zero-shot probability of a tag. Defaults to 0.1
+        """
+        self.tag_fpath = Path(tag_fpath)
+        self.labels = tuple(labels)
+        self.max_tags = max_tags
+        self.min_probability = min_probability
+        self._label_embeddings: np.ndarray | None = None
+
+        # longer labels first, so that "hot dog" wins over "dog"
+        alternatives = "|".join(
+            re.escape(label) for label in sorted(self.labels, key=len, reverse=True)
+        )
+        self._label_pattern = re.compile(rf"\b({alternatives})(?:s|es)?\b")
+
+        self._tags: dict[int, list[str]] = {}
+        self._postings: dict[str, set[int]] = {label: set() for label in self.labels}
+
+        logger.info(f"Initialize tag server with local file {self.tag_fpath}")
+        if self.tag_fpath.exists():
+            with open(self.tag_fpath) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if "tags" in record:
+                        self._add(record["id"], record["tags"])
+                    else:
+                        self._remove(record["id"])
+            logger.info(f"Found tags of {self.size()} images")
+        else:
+            os.makedirs(self.tag_fpath.parent, exist_ok=True)
+
+    def prompts(self) -> list[str]:
+        """Get the text prompts of the labels, to be embedded by the embedding server
+
+        Returns:
+            list[str]: one prompt per label
+        """
+        return [f"a photo of a {label}" for label in self.labels]
+
+    def set_label_embeddings(self, label_embeddings: np.ndarray) -> None:
+        """Set the label bank, i.e. the embeddings of `prompts`
+
+        Args:
+            label_embeddings (np.ndarray): numpy array of normalized embeddings, 2D with shape (len(labels), embedding dimension)
+        """
+        assert len(label_embeddings) == len(
+            self.labels
+        ), f"{len(label_embeddings)=} != {len(self.labels)=}"
+        self._label_embeddings = np.asarray(label_embeddings, dtype=np.float32)
+
+    def tag(self, embeddings: np.ndarray) -> list[list[str]]:
+        """Tag a batch of images by their embeddings
+
+        Args:
+            embeddings (np.ndarray): numpy array of normalized image embeddings, 2D with shape (batch, embedding dimension)
+
+        Returns:
+            list[list[str]]: tags of each image, most probable first
+        """
+        assert self._label_embeddings is not None, "Label embeddings are not set"
+        logits = 100.0 * (
+            np.asarray(embeddings, dtype=np.float32) @ self._label_embeddings.T
+        )
+        # softmax over labels, same as CLIP zero-shot classification
+        probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probs /= probs.sum(axis=1, keepdims=True)
+        top = np.argsort(-probs, axis=1)[:, : self.max_tags]
+        return [
+            [self.labels[i] for i in row if p[i] >= self.min_probability]
+            for row, p in zip(top, probs)
+        ]
+
+    def _add(self, id: int, tags: list[str]) -> None:
+        self._tags[id] = tags
+        for tag in tags:
+            self._postings[tag].add(id)
+
+    def _remove(self, id: int) -> None:
+        for tag in self._tags.pop(id, []):
+            self._postings[tag].discard(id)
+
+    def _write(self, records: list[dict]) -> None:
+        with open(self.tag_fpath, "a") as f:
+            f.write("".join(json.dumps(r) + "\n" for r in records))
+
+    def size(self) -> int:
+        """Get the number of tagged images
+
+        Returns:
+            int: number of images
+        """
+        return len(self._tags)
+
+    def insert(self, id: int, tags: list[str]) -> None:
+        """Insert the tags of an image
+
+        Args:
+            id (int): image unique ID
+            tags (list[str]): tags of the image, see `tag`
+        """
+        self.insert_batch([id], [tags])
+
+    def insert_batch(self, ids: list[int], tags: list[list[str]]) -> None:
+        """Insert the tags of a batch of images
+
+        Args:
+            ids (list[int]): image unique IDs
+            tags (list[list[str]]): tags of each image, see `tag`
+        """
+        assert len(ids) == len(tags), f"{len(ids)=} != {len(tags)=}"
+        self._write([{"id": id, "tags": t} for id, t in zip(ids, tags)])
+        for id, t in zip(ids, tags):
+            self._add(id, t)
+
+    def delete(self, id: int) -> None:
+        """Delete the tags of an image
+
+        Args:
+            id (int): image unique ID
+        """
+        self.delete_batch([id])
+
+    def delete_batch(self, ids: list[int]) -> None:
+        """Delete the tags of a batch of images
+
+        Args:
+            ids (list[int]): image unique IDs
+        """
+        self._write([{"id": id} for id in ids])
+        for id in ids:
+            self._remove(id)
+
+    def get_tags(self, id: int) -> list[str]:
+        """Get the tags of an image
+
+        Args:
+            id (int): image unique ID
+
+        Returns:
+            list[str]: tags of the image, most probable first
+        """
+        return self._tags.get(id, [])
+
+    def match(self, text: str) -> list[str]:
+        """Find the known labels mentioned in a text, plurals included
+
+        Args:
+            text (str): text string
+
+        Returns:
+            list[str]: labels in the order of their first mention
+        """
+        found = self._label_pattern.findall(text.lower())
+        return list(dict.fromkeys(found))
+
+    def search(self, tags: list[str], match_all: bool = True) -> set[int]:
+        """Get the images having the tags, from the posting lists
+
+        Args:
+            tags (list[str]): tags to search
+            match_all (bool, optional): images having all the tags, otherwise any of them. Defaults to True
+
+        Raises:
+            ValueError: if a tag is not a known label
+
+        Returns:
+            set[int]: image unique IDs
+        """
+        unknown = [tag for tag in tags if tag not in self._postings]
+        if unknown:
+            raise ValueError(f"Unknown tags: {unknown}")
+        postings = sorted((self._postings[tag] for tag in tags), key=len)
+        if len(postings) == 0:
+            return set()
+        if match_all:
+            return set.intersection(*postings)
+        return set.union(*postings)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -1,10 +1,13 @@
 import sys
+import time
 from pathlib import Path
 
+import pytest
+
 sys.path.append(str(Path(__file__).parent.parent / "pysrc"))
 
 from backend import BackendServer
-from config import Config
+from config import Config, load_active_model
 
 
 def test_backend():
@@ -37,6 +40,15 @@ def test_backend():
         assert len(results) == 1
         assert results[0] == id
 
+    # test search with filter
+    img = backend_server.get_image(ids[0])
+    results = backend_server.search_with_image(img, top_k=1, filter=f"id != {ids[0]}")
+    assert ids[0] not in results
+    results = backend_server.search_with_image(
+        img, top_k=1, filter=f"width == {img.shape[1]} and height == {img.shape[0]}"
+    )
+    assert results[0] == ids[0]
+
     # test search with text
     ## add target image into database
     image_fpath = config.test_image_dpath / "000000001000.jpg"
@@ -55,6 +67,37 @@ def test_backend():
     )
     assert id in results
 
+    # test load more from the cached search results
+    first, cursor = backend_server.paged_search_with_image(img, top_k=2)
+    assert first[0] == id
+    pages = list(first)
+    while cursor is not None:
+        page, cursor = backend_server.load_more(cursor, top_k=2)
+        assert len(page) <= 2
+        pages += page
+    assert pages == backend_server.search_with_image(img, top_k=len(ids))
+
+    # test search with tags
+    assert "person" in backend_server.get_image_tags(id)
+    results = backend_server.search_with_text("people", top_k=5, tags=["person"])
+    assert id in results
+    results = backend_server.search_with_text("a person", top_k=1)
+    assert "person" in backend_server.get_image_tags(results[0])
+    with pytest.raises(ValueError):
+        backend_server.search_with_text("people", top_k=5, tags=["unicorn"])
+
+    # test delete images in bulk
+    deleted_ids = ids[:3]
+    ids = ids[3:]
+    backend_server.delete_images(deleted_ids + deleted_ids[:1] + [-1])
+    assert backend_server.get_database_size() == len(ids)
+    for id in deleted_ids:
+        assert id not in backend_server.search_with_image(img, top_k=len(ids) + 3)
+    while backend_server.compactor.pending_count() > 0:
+        time.sleep(0.1)
+    for id in deleted_ids:
+        assert not Path(backend_server.get_image_uri(id)).exists()
+
     # test delete image
     while len(ids) > 0:
         id = ids.pop()
@@ -64,6 +107,47 @@ def test_backend():
         assert cnt == len(ids)
 
 
+def test_reindex():
+    config = Config(
+        root_dpath=Path(__file__).parent.parent,
+        local_database_relative_fpath=Path("data/test/reindex.db"),
+        local_image_relative_dpath=Path("data/test/reindex_images"),
+        use_open_clip=True,
+        open_clip_model_name=("ViT-L-14-336-quickgelu", "openai"),
+        test_with_empty_database=True,
+        test_image_relative_dpath=Path("data/inputs/val2017"),
+    )
+    backend_server = BackendServer(config)
+    test_image_fpaths = list(config.test_image_dpath.glob("*.jpg"))
+    ids = [backend_server.insert_image(fpath) for fpath in test_image_fpaths[:5]]
+
+    target_config = Config(
+        root_dpath=Path(__file__).parent.parent,
+        local_database_relative_fpath=Path("data/test/reindex.shadow.db"),
+        local_image_relative_dpath=Path("data/test/reindex_images"),
+        use_open_clip=True,
+        open_clip_model_name=("ViT-B-32-quickgelu", "openai"),
+    )
+    job = backend_server.start_reindex(target_config, batch_size=2)
+    # keep writing while the job is running
+    ids.append(backend_server.insert_image(test_image_fpaths[5]))
+    backend_server.delete_image(ids.pop(0))
+    job.join()
+
+    assert backend_server.config.open_clip_model_name == target_config.open_clip_model_name
+    assert backend_server.get_database_size() == len(ids)
+    # the cutover is kept after restart
+    assert load_active_model(config).local_database_fpath == target_config.local_database_fpath
+    for id in ids:
+        img = backend_server.get_image(id)
+        results = backend_server.search_with_image(img, top_k=1)
+        assert results[0] == id
+
+    # inserts after the cutover go to the new database
+    id = backend_server.insert_image(test_image_fpaths[6])
+    assert backend_server.get_database_size() == len(ids) + 1
+
+
 if __name__ == "__main__":
     import pytest
 
@@ -0,0 +1,71 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent / "pysrc"))
+
+from database_server import NumpyLocalServer
+
+
+def _embeddings(count: int, seed: int) -> np.ndarray:
+    x = np.random.default_rng(seed).standard_normal((count, 8)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("tear", ["body", "header", "checksum"])
+def test_torn_snapshot(tmp_path, tear):
+    database_fpath = tmp_path / "test.vec"
+    svr = NumpyLocalServer(database_fpath, 8, embedding_dtype="int8")
+    ids = svr.insert_batch(_embeddings(10, 0))
+    svr.snapshot()
+    whole_size = svr.snapshot_fpath.stat().st_size
+    ids += svr.insert_batch(_embeddings(10, 1))
+    svr.delete_batch(ids[:2])
+    svr.snapshot()
+    size = svr.snapshot_fpath.stat().st_size
+
+    # tear the last segment, as if the process crashed while writing it
+    if tear == "body":
+        torn_size = size - 10
+    elif tear == "header":
+        torn_size = whole_size + 30
+    else:
+        torn_size = size
+        data = bytearray(svr.snapshot_fpath.read_bytes())
+        data[-100] ^= 0xFF
+        svr.snapshot_fpath.write_bytes(bytes(data))
+    with open(svr.snapshot_fpath, "r+b") as f:
+        f.truncate(torn_size)
+
+    # the changes of the torn segment are replayed from the log
+    svr = NumpyLocalServer(database_fpath, 8, embedding_dtype="int8")
+    assert svr.snapshot_fpath.stat().st_size == whole_size
+    assert sorted(svr.all_id()) == sorted(ids[2:])
+
+    # the next segment is appended after the last whole one
+    ids += svr.insert_batch(_embeddings(10, 2))
+    svr.snapshot()
+    svr = NumpyLocalServer(database_fpath, 8, embedding_dtype="int8")
+    assert sorted(svr.all_id()) == sorted(ids[2:])
+    assert svr.size() == len(ids) - 2
+    results = svr.search(_embeddings(10, 2)[0], top_k=1)
+    assert results[0][0] == ids[-10]
+
+
+def test_compacted_snapshot_is_missing(tmp_path):
+    database_fpath = tmp_path / "test.vec"
+    svr = NumpyLocalServer(database_fpath, 8, embedding_dtype="int8")
+    ids = svr.insert_batch(_embeddings(10, 0))
+    svr.delete_batch(ids[:2])
+    svr.compact()
+
+    # the log was restarted, so the entities are only in the snapshot
+    svr.snapshot_fpath.unlink()
+    with pytest.raises(AssertionError):
+        NumpyLocalServer(database_fpath, 8, embedding_dtype="int8")
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main(["-s", "-vv", __file__]))